@@ -0,0 +1,53 @@
+"""add bot tokens
+
+Revision ID: 3f1c2a7d9b04
+Revises: e8bf7776f1ea
+Create Date: 2026-10-18 09:12:41.208133
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+import tiktoken
+
+
+# revision identifiers, used by Alembic.
+revision: str = '3f1c2a7d9b04'
+down_revision: Union[str, None] = 'e8bf7776f1ea'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+bots = sa.table(
+    'bots',
+    sa.column('id', sa.UUID()),
+    sa.column('context', sa.JSON()),
+    sa.column('tokens', sa.Integer()),
+)
+
+
+def upgrade() -> None:
+    op.add_column('bots', sa.Column('tokens', sa.Integer(), server_default='0', nullable=False))
+
+    # Backfill per-message token counts and the running total for existing bots.
+    # The encoding is only loaded when there is something to count, so a fresh
+    # database can be migrated without fetching it.
+    enc = None
+    connection = op.get_bind()
+    for id, context in connection.execute(sa.select(bots.c.id, bots.c.context)).all():
+        if context is None:
+            continue
+        if enc is None:
+            enc = tiktoken.encoding_for_model("gpt-4o")
+        total = 0
+        for message in context.get("messages", []):
+            message["tokens"] = len(enc.encode_ordinary(str(message.get("content", "") or "")))
+            total += message["tokens"]
+        connection.execute(
+            bots.update().where(bots.c.id == id).values(context=context, tokens=total)
+        )
+
+
+def downgrade() -> None:
+    op.drop_column('bots', 'tokens')
@@ -0,0 +1,94 @@
+"""create messages table
+
+Revision ID: a7d05e3c41b8
+Revises: 3f1c2a7d9b04
+Create Date: 2026-10-18 10:03:17.554610
+
+"""
+from typing import Sequence, Union
+import uuid
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'a7d05e3c41b8'
+down_revision: Union[str, None] = '3f1c2a7d9b04'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+bots = sa.table(
+    'bots',
+    sa.column('id', sa.UUID()),
+    sa.column('context', sa.JSON()),
+)
+
+messages = sa.table(
+    'messages',
+    sa.column('bot_id', sa.UUID()),
+    sa.column('seq', sa.Integer()),
+    sa.column('id', sa.UUID(as_uuid=False)),
+    sa.column('role', sa.String()),
+    sa.column('content', sa.Text()),
+    sa.column('tokens', sa.Integer()),
+)
+
+
+def upgrade() -> None:
+    op.create_table('messages',
+    sa.Column('bot_id', sa.UUID(), nullable=False),
+    sa.Column('seq', sa.Integer(), nullable=False),
+    sa.Column('id', sa.UUID(as_uuid=False), nullable=False),
+    sa.Column('role', sa.String(), nullable=False),
+    sa.Column('content', sa.Text(), nullable=True),
+    sa.Column('tokens', sa.Integer(), server_default='0', nullable=False),
+    sa.ForeignKeyConstraint(['bot_id'], ['bots.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('bot_id', 'seq'),
+    sa.UniqueConstraint('id')
+    )
+
+    # Move each bot's messages out of the context blob, one bot per statement.
+    connection = op.get_bind()
+    for bot_id, context in connection.execute(sa.select(bots.c.id, bots.c.context)).all():
+        if context is None:
+            continue
+        rows = [
+            {
+                'bot_id': bot_id,
+                'seq': seq,
+                'id': message.get('id') or str(uuid.uuid4()),
+                'role': message['role'],
+                'content': message.get('content'),
+                'tokens': message.get('tokens') or 0,
+            }
+            for seq, message in enumerate(context.pop('messages', []))
+        ]
+        if rows:
+            connection.execute(messages.insert(), rows)
+        connection.execute(
+            bots.update().where(bots.c.id == bot_id).values(context=context)
+        )
+
+
+def downgrade() -> None:
+    connection = op.get_bind()
+    for bot_id, context in connection.execute(sa.select(bots.c.id, bots.c.context)).all():
+        rows = connection.execute(
+            sa.select(
+                messages.c.role, messages.c.content, messages.c.id, messages.c.tokens
+            )
+            .where(messages.c.bot_id == bot_id)
+            .order_by(messages.c.seq)
+        ).all()
+        context = dict(context or {})
+        context['messages'] = [
+            {'role': role, 'content': content, 'id': str(id), 'tokens': tokens}
+            for role, content, id, tokens in rows
+        ]
+        connection.execute(
+            bots.update().where(bots.c.id == bot_id).values(context=context)
+        )
+
+    op.drop_table('messages')
@@ -0,0 +1,85 @@
+"""compress message content
+
+Revision ID: c5e8a1f07d92
+Revises: a7d05e3c41b8
+Create Date: 2026-10-18 14:26:08.391725
+
+"""
+from typing import Sequence, Union
+import zlib
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'c5e8a1f07d92'
+down_revision: Union[str, None] = 'a7d05e3c41b8'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+BATCH_SIZE = 1000
+
+messages = sa.table(
+    'messages',
+    sa.column('bot_id', sa.UUID()),
+    sa.column('seq', sa.Integer()),
+    sa.column('content', sa.Text()),
+    sa.column('content_z', sa.LargeBinary()),
+)
+
+
+def batches(connection, column, condition):
+    # Walk the primary key so every batch is a cheap index range scan.
+    last = None
+    while True:
+        query = (
+            sa.select(messages.c.bot_id, messages.c.seq, column)
+            .where(condition)
+            .order_by(messages.c.bot_id, messages.c.seq)
+            .limit(BATCH_SIZE)
+        )
+        if last is not None:
+            query = query.where(sa.tuple_(messages.c.bot_id, messages.c.seq) > last)
+        rows = connection.execute(query).all()
+        if not rows:
+            return
+        yield rows
+        last = (rows[-1][0], rows[-1][1])
+
+
+def rewrite(connection, rows):
+    connection.execute(
+        messages.update()
+        .where(
+            messages.c.bot_id == sa.bindparam('b_bot_id'),
+            messages.c.seq == sa.bindparam('b_seq'),
+        )
+        .values(
+            content=sa.bindparam('b_content'),
+            content_z=sa.bindparam('b_content_z'),
+        ),
+        rows,
+    )
+
+
+def upgrade() -> None:
+    # Existing rows are compressed by `python -m app.compression`, whenever the
+    # deployment opts in, rather than here.
+    op.add_column('messages', sa.Column('content_z', sa.LargeBinary(), nullable=True))
+
+
+def downgrade() -> None:
+    connection = op.get_bind()
+    condition = messages.c.content_z.is_not(None)
+    for rows in batches(connection, messages.c.content_z, condition):
+        rewrite(connection, [
+            {
+                'b_bot_id': bot_id,
+                'b_seq': seq,
+                'b_content': zlib.decompress(content_z).decode(),
+                'b_content_z': None,
+            }
+            for bot_id, seq, content_z in rows
+        ])
+    op.drop_column('messages', 'content_z')
@@ -0,0 +1,26 @@
+"""index bot tokens
+
+Revision ID: d2b7e94c6a13
+Revises: c5e8a1f07d92
+Create Date: 2026-10-18 16:41:52.208316
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'd2b7e94c6a13'
+down_revision: Union[str, None] = 'c5e8a1f07d92'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_index(op.f('ix_bots_tokens'), 'bots', ['tokens'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index(op.f('ix_bots_tokens'), table_name='bots')
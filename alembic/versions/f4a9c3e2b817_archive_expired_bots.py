@@ -0,0 +1,32 @@
+"""archive expired bots
+
+Revision ID: f4a9c3e2b817
+Revises: d2b7e94c6a13
+Create Date: 2026-10-18 19:12:40.518273
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'f4a9c3e2b817'
+down_revision: Union[str, None] = 'd2b7e94c6a13'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column('bots', sa.Column('expired_at', sa.DateTime(timezone=True), nullable=True))
+    op.add_column('bots', sa.Column('farewell_at', sa.DateTime(timezone=True), nullable=True))
+    op.create_index(op.f('ix_bots_expired_at'), 'bots', ['expired_at'], unique=False)
+    op.create_index(op.f('ix_bots_farewell_at'), 'bots', ['farewell_at'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index(op.f('ix_bots_farewell_at'), table_name='bots')
+    op.drop_index(op.f('ix_bots_expired_at'), table_name='bots')
+    op.drop_column('bots', 'farewell_at')
+    op.drop_column('bots', 'expired_at')
@@ -0,0 +1,168 @@
+import asyncio
+import math
+import os
+import time
+from typing import AsyncGenerator, AsyncIterator, Dict, Hashable, Tuple
+
+CHAT_RATE_PER_MINUTE = float(os.getenv("CHAT_RATE_PER_MINUTE", "20"))
+CHAT_RATE_BURST = float(os.getenv("CHAT_RATE_BURST", "5"))
+CHAT_MAX_UPSTREAM = int(os.getenv("CHAT_MAX_UPSTREAM", "64"))
+# How long a request may queue for its turn before giving up with a 429.
+CHAT_ADMISSION_TIMEOUT = float(os.getenv("CHAT_ADMISSION_TIMEOUT", "2"))
+RATE_LIMIT_MAX_KEYS = int(os.getenv("RATE_LIMIT_MAX_KEYS", "10000"))
+
+
+class Rejected(Exception):
+    def __init__(self, reason: str, retry_after: float):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+    @property
+    def headers(self) -> Dict[str, str]:
+        return {"Retry-After": str(max(1, math.ceil(self.retry_after)))}
+
+
+class RateLimiter:
+    """Token bucket per key.
+
+    A request that finds the bucket empty reserves the next token and waits
+    for it, as long as that is within the admission timeout; otherwise it is
+    rejected with the time until a token would be free.
+    """
+
+    def __init__(
+        self,
+        rate_per_minute: float = CHAT_RATE_PER_MINUTE,
+        burst: float = CHAT_RATE_BURST,
+        max_keys: int = RATE_LIMIT_MAX_KEYS,
+    ):
+        self.rate = rate_per_minute / 60
+        self.burst = burst
+        self.max_keys = max_keys
+        self.buckets: Dict[Hashable, Tuple[float, float]] = {}
+
+    def _tokens(self, key: Hashable, now: float) -> float:
+        tokens, updated = self.buckets.get(key, (self.burst, now))
+        return min(self.burst, tokens + (now - updated) * self.rate)
+
+    async def acquire(self, key: Hashable, timeout: float = CHAT_ADMISSION_TIMEOUT):
+        now = time.monotonic()
+        tokens = self._tokens(key, now)
+        wait = 0.0 if tokens >= 1 else (1 - tokens) / self.rate
+        if wait > timeout:
+            raise Rejected("rate", wait)
+        self.buckets[key] = (tokens - 1, now)
+        if len(self.buckets) > self.max_keys:
+            self._evict(now)
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def _evict(self, now: float):
+        # A full bucket is the same as no bucket, so those can go.
+        full = [key for key in self.buckets if self._tokens(key, now) >= self.burst]
+        for key in full:
+            del self.buckets[key]
+
+
+class Lease:
+    def __init__(self, semaphore: asyncio.Semaphore, on_release=None):
+        self._semaphore = semaphore
+        self._on_release = on_release
+        self.released = False
+
+    def release(self):
+        if self.released:
+            return
+        self.released = True
+        self._semaphore.release()
+        if self._on_release is not None:
+            self._on_release()
+
+
+async def _acquire(semaphore: asyncio.Semaphore, timeout: float) -> bool:
+    if not semaphore.locked():
+        await semaphore.acquire()
+        return True
+    try:
+        await asyncio.wait_for(semaphore.acquire(), timeout)
+        return True
+    except asyncio.TimeoutError:
+        return False
+
+
+class ConcurrencyLimit:
+    def __init__(self, limit: int, reason: str):
+        self.reason = reason
+        self._semaphore = asyncio.Semaphore(limit)
+
+    async def acquire(self, timeout: float = CHAT_ADMISSION_TIMEOUT) -> Lease:
+        if not await _acquire(self._semaphore, timeout):
+            raise Rejected(self.reason, timeout)
+        return Lease(self._semaphore)
+
+
+class KeyedConcurrencyLimit:
+    """A ConcurrencyLimit per key, dropped once nobody holds or waits on it."""
+
+    def __init__(self, limit: int, reason: str):
+        self.limit = limit
+        self.reason = reason
+        self._slots: Dict[Hashable, Tuple[asyncio.Semaphore, int]] = {}
+
+    def _enter(self, key: Hashable) -> asyncio.Semaphore:
+        semaphore, users = self._slots.get(key, (None, 0))
+        if semaphore is None:
+            semaphore = asyncio.Semaphore(self.limit)
+        self._slots[key] = (semaphore, users + 1)
+        return semaphore
+
+    def _exit(self, key: Hashable):
+        semaphore, users = self._slots[key]
+        if users == 1:
+            del self._slots[key]
+        else:
+            self._slots[key] = (semaphore, users - 1)
+
+    async def acquire(
+        self, key: Hashable, timeout: float = CHAT_ADMISSION_TIMEOUT
+    ) -> Lease:
+        semaphore = self._enter(key)
+        try:
+            acquired = await _acquire(semaphore, timeout)
+        except BaseException:
+            self._exit(key)
+            raise
+        if not acquired:
+            self._exit(key)
+            raise Rejected(self.reason, timeout)
+        return Lease(semaphore, on_release=lambda: self._exit(key))
+
+
+def _release_acquired(acquiring: "asyncio.Task[Lease]"):
+    if not acquiring.cancelled() and acquiring.exception() is None:
+        acquiring.result().release()
+
+
+def abandon(acquiring: "asyncio.Task[Lease]"):
+    """Give up on a lease being acquired in a task, releasing it if it was."""
+    acquiring.cancel()
+    acquiring.add_done_callback(_release_acquired)
+
+
+async def hold(stream: AsyncIterator[str], lease: Lease) -> AsyncGenerator[str, None]:
+    """Pass ``stream`` through, releasing ``lease`` once it is finished."""
+    try:
+        async for chunk in stream:
+            yield chunk
+    finally:
+        lease.release()
+        aclose = getattr(stream, "aclose", None)
+        if aclose is not None:
+            await aclose()
+
+
+rate_limiter = RateLimiter()
+# Turns on a bot are serialized so each one sees the previous turn's rows.
+bot_turns = KeyedConcurrencyLimit(1, "bot")
+upstream_slots = ConcurrencyLimit(CHAT_MAX_UPSTREAM, "upstream")
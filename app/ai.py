@@ -1,116 +1,328 @@
+import asyncio
 import logging
-from typing import AsyncGenerator, List
+import os
+from functools import lru_cache
+from typing import (
+    TYPE_CHECKING,
+    AsyncGenerator,
+    AsyncIterator,
+    Callable,
+    Dict,
+    List,
+    Optional,
+    Protocol,
+    Tuple,
+)
+
+import httpx
 
-from openai import AsyncOpenAI
-from openai.types.chat import (
-    ChatCompletionAssistantMessageParam,
+from app.admission import CHAT_MAX_UPSTREAM
+from app.metrics import (
+    LLM_COMPLETION_TOKENS,
+    LLM_FIRST_TOKEN_TIMEOUTS,
+    LLM_HEDGED_REQUESTS,
+    LLM_PROMPT_TOKENS,
+)
+from app.types import (
+    ChatCompletionMessageParam,
     ChatCompletionUserMessageParam,
+    ChatMessage,
 )
-from openai.types.chat.chat_completion_message_param import ChatCompletionMessageParam
 
-from app.types import ChatCompletionMessageParamID
+if TYPE_CHECKING:
+    from openai import AsyncOpenAI
+    from openai.types.completion_usage import CompletionUsage
 
+# "openai" talks to OPENAI_BASE_URL (the real API unless pointed elsewhere,
+# e.g. at app.fake_llm's server); "fake" generates replies in process.
+LLM_BACKEND = os.getenv("LLM_BACKEND", "openai")
 
-client = AsyncOpenAI()
+# Deadlines, in seconds. The read timeout bounds the wait for each chunk of a
+# stream once it has started (and for a whole non-streamed response).
+LLM_CONNECT_TIMEOUT = float(os.getenv("LLM_CONNECT_TIMEOUT", "5"))
+LLM_READ_TIMEOUT = float(os.getenv("LLM_READ_TIMEOUT", "60"))
+LLM_FIRST_TOKEN_TIMEOUT = float(os.getenv("LLM_FIRST_TOKEN_TIMEOUT", "30"))
+# A stream still without a token after this long races a duplicate request;
+# 0 turns hedging off.
+LLM_HEDGE_AFTER = float(os.getenv("LLM_HEDGE_AFTER", "3"))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "2"))
+# One connection per upstream slot plus room for hedges, kept alive between
+# turns so they don't pay for a new connection and TLS handshake.
+LLM_MAX_CONNECTIONS = int(os.getenv("LLM_MAX_CONNECTIONS", str(2 * CHAT_MAX_UPSTREAM)))
+LLM_MAX_KEEPALIVE = int(os.getenv("LLM_MAX_KEEPALIVE", str(CHAT_MAX_UPSTREAM)))
+LLM_KEEPALIVE_EXPIRY = float(os.getenv("LLM_KEEPALIVE_EXPIRY", "120"))
+LLM_PREWARM_CONNECTIONS = int(os.getenv("LLM_PREWARM_CONNECTIONS", "4"))
 
 model = "gpt-4o-mini"
 
+SUMMARY_MAX_TOKENS = 400
+
 logger = logging.getLogger(__name__)
 
 
 def transform_to_openai_type(
-    messages: List[ChatCompletionMessageParamID],
+    messages: List[ChatMessage],
 ) -> List[ChatCompletionMessageParam]:
-    transformed_messages: List[ChatCompletionMessageParam] = []
-    for message in messages:
-        role = message["role"]
-        content = str(message.get("content", "") or "")
-        if role == "user":
-            transformed_messages.append(
-                ChatCompletionUserMessageParam(
-                    role="user",
-                    content=content,
+    return [message.payload for message in messages]
+
+
+class UpstreamTimeout(Exception):
+    pass
+
+
+_END = object()
+
+
+async def _first(stream: AsyncIterator[str]):
+    try:
+        return await stream.__anext__()
+    except StopAsyncIteration:
+        return _END
+
+
+async def _abandon(task: asyncio.Task, stream: AsyncIterator[str]):
+    task.cancel()
+    await asyncio.wait({task})
+    aclose = getattr(stream, "aclose", None)
+    if aclose is not None:
+        await aclose()
+
+
+async def hedged(
+    start: Callable[[], AsyncIterator[str]],
+    hedge_after: float = LLM_HEDGE_AFTER,
+    first_token_timeout: float = LLM_FIRST_TOKEN_TIMEOUT,
+) -> AsyncGenerator[str, None]:
+    """Stream from ``start()``, racing a second request if the first is slow.
+
+    If no token has arrived ``hedge_after`` seconds in, ``start()`` is called
+    again and whichever stream yields first is passed through; the other is
+    cancelled. UpstreamTimeout is raised if there is still no token after
+    ``first_token_timeout`` seconds.
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + first_token_timeout
+    hedge_at = loop.time() + hedge_after if hedge_after > 0 else None
+    attempts: Dict[asyncio.Task, Tuple[str, AsyncIterator[str]]] = {}
+    hedging = False
+
+    def launch(name: str):
+        stream = start()
+        attempts[asyncio.ensure_future(_first(stream))] = (name, stream)
+
+    launch("primary")
+    winner: Optional[Tuple[str, AsyncIterator[str]]] = None
+    try:
+        while winner is None:
+            now = loop.time()
+            if now >= deadline:
+                LLM_FIRST_TOKEN_TIMEOUTS.inc()
+                raise UpstreamTimeout(
+                    f"no token from upstream after {first_token_timeout:g}s"
                 )
+            wake = deadline if hedge_at is None else min(deadline, hedge_at)
+            done, _ = await asyncio.wait(
+                attempts, timeout=wake - now, return_when=asyncio.FIRST_COMPLETED
             )
-        elif role == "assistant":
-            transformed_messages.append(
-                ChatCompletionAssistantMessageParam(
-                    role="assistant",
-                    content=content,
-                )
+            for task in done:
+                name, stream = attempts.pop(task)
+                if task.exception() is None:
+                    winner, first = (name, stream), task.result()
+                    break
+                await _abandon(task, stream)
+                # Fail only once every attempt has.
+                if not attempts:
+                    raise task.exception()  # type: ignore[misc]
+            if winner is None and hedge_at is not None and loop.time() >= hedge_at:
+                hedge_at = None
+                hedging = True
+                logger.info("no token after %gs, hedging the request", hedge_after)
+                launch("hedge")
+
+        if hedging:
+            LLM_HEDGED_REQUESTS.labels(winner=winner[0]).inc()
+        for task, (_, stream) in list(attempts.items()):
+            del attempts[task]
+            await _abandon(task, stream)
+        if first is _END:
+            return
+        yield first
+        async for item in winner[1]:
+            yield item
+    finally:
+        for task, (_, stream) in attempts.items():
+            await _abandon(task, stream)
+        if winner is not None:
+            aclose = getattr(winner[1], "aclose", None)
+            if aclose is not None:
+                await aclose()
+
+
+class ChatBackend(Protocol):
+    async def warm(self) -> None: ...
+
+    def stream(
+        self, messages: List[ChatCompletionMessageParam]
+    ) -> AsyncIterator[str]: ...
+
+    async def complete(
+        self, messages: List[ChatCompletionMessageParam], max_tokens: int
+    ) -> str: ...
+
+
+class OpenAIBackend:
+    """Talks to the OpenAI chat completions API (or anything speaking it)."""
+
+    def __init__(self, client: Optional["AsyncOpenAI"] = None, model: str = model):
+        if client is None:
+            # openai takes about half a second to import, so only pay for it
+            # when this backend is actually used.
+            from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+
+            client = AsyncOpenAI(
+                timeout=httpx.Timeout(
+                    LLM_READ_TIMEOUT,
+                    connect=LLM_CONNECT_TIMEOUT,
+                    pool=LLM_CONNECT_TIMEOUT,
+                ),
+                max_retries=LLM_MAX_RETRIES,
+                http_client=DefaultAsyncHttpxClient(
+                    limits=httpx.Limits(
+                        max_connections=LLM_MAX_CONNECTIONS,
+                        max_keepalive_connections=LLM_MAX_KEEPALIVE,
+                        keepalive_expiry=LLM_KEEPALIVE_EXPIRY,
+                    )
+                ),
             )
-        else:
-            raise ValueError("unexpected message type")
-    return transformed_messages
+        self.client = client
+        self.model = model
+
+    async def warm(self, connections: int = LLM_PREWARM_CONNECTIONS):
+        # Concurrent requests each open a connection of their own, which then
+        # stays in the pool for the first turns to reuse.
+        client = self.client.with_options(max_retries=0)
+        await asyncio.gather(*(client.models.list() for _ in range(connections)))
+
+    async def stream(
+        self, messages: List[ChatCompletionMessageParam]
+    ) -> AsyncGenerator[str, None]:
+        stream = await self.client.chat.completions.create(
+            model=self.model,
+            messages=messages,
+            stream=True,
+            stream_options={"include_usage": True},
+        )
+
+        logger.info("processing stream")
+        # Closing the stream drops the upstream connection, so a cancelled
+        # consumer stops the completion instead of paying for unread tokens.
+        async with stream:
+            async for chunk in stream:
+                if chunk.usage:
+                    self._count_usage(chunk.usage)
+                if (
+                    chunk.choices is not None
+                    and len(chunk.choices) > 0
+                    and chunk.choices[0].delta.content is not None
+                ):
+
+                    content = chunk.choices[0].delta.content
+                    yield content
+
+    async def complete(
+        self, messages: List[ChatCompletionMessageParam], max_tokens: int
+    ) -> str:
+        response = await self.client.chat.completions.create(
+            model=self.model,
+            messages=messages,
+            max_tokens=max_tokens,
+        )
+        if response.usage:
+            self._count_usage(response.usage)
+        return response.choices[0].message.content or ""
+
+    def _count_usage(self, usage: "CompletionUsage"):
+        LLM_PROMPT_TOKENS.labels(model=self.model).inc(usage.prompt_tokens)
+        LLM_COMPLETION_TOKENS.labels(model=self.model).inc(usage.completion_tokens)
+
+
+def backend_from_env() -> ChatBackend:
+    if LLM_BACKEND == "openai":
+        return OpenAIBackend()
+    if LLM_BACKEND == "fake":
+        from app.fake_llm import FakeBackend
+
+        return FakeBackend()
+    raise ValueError(f"Unknown LLM_BACKEND {LLM_BACKEND!r}")
+
+
+@lru_cache(maxsize=None)
+def get_backend() -> ChatBackend:
+    return backend_from_env()
 
 
 async def generate_chat(
-    messages: List[ChatCompletionMessageParamID],
+    messages: List[ChatMessage],
 ) -> AsyncGenerator[str, None]:
     logger.info("generating chat")
 
     messages_openai = transform_to_openai_type(messages=messages)
-    stream = await client.chat.completions.create(
-        model=model,
-        messages=messages_openai,
-        stream=True,
-        stream_options={"include_usage": True},
-    )
+    backend = get_backend()
+    async for content in hedged(lambda: backend.stream(messages_openai)):
+        yield content
+
 
-    logger.info("processing stream")
-    async for chunk in stream:
-        if chunk.usage:
-            print(chunk.usage)
-        if (
-            chunk.choices is not None
-            and len(chunk.choices) > 0
-            and chunk.choices[0].delta.content is not None
-        ):
+async def summarize(
+    previous: Optional[str],
+    messages: List[ChatMessage],
+) -> str:
+    logger.info("summarizing %d messages", len(messages))
 
-            content = chunk.choices[0].delta.content
-            yield content
+    transcript = "\n".join(
+        f"{'Them' if m.role == 'user' else 'You'}: {m.content or ''}"
+        for m in messages
+    )
+    prompt = (
+        "Summarize this earlier part of your conversation in a few sentences, "
+        "written to yourself. Keep names, facts and anything you promised to "
+        "follow up on.\n\n"
+    )
+    if previous:
+        prompt += f"Summary so far:\n{previous}\n\n"
+    prompt += f"Conversation to fold in:\n{transcript}"
+
+    return await get_backend().complete(
+        [ChatCompletionUserMessageParam(role="user", content=prompt)],
+        max_tokens=SUMMARY_MAX_TOKENS,
+    )
 
 
-def response_for_stream(stream) -> str:
+async def response_for_stream(stream: AsyncIterator[str]) -> str:
     response: str = ""
 
-    for chunk in stream:
-        if chunk.choices[0].delta.content is not None:
-            content = chunk.choices[0].delta.content
-            response += content
+    async for content in stream:
+        response += content
     return response
 
 
-if __name__ == "__main__":
-    messages: List[ChatCompletionMessageParam] = [
-        ChatCompletionUserMessageParam(
-            role="user", content="Say this is a test 2 times."
-        )
+async def main():
+    messages: List[ChatMessage] = [
+        ChatMessage("user", "Say this is a test 2 times.", id="demo:1", tokens=0)
     ]
 
-    stream = client.chat.completions.create(
-        model=model,
-        messages=messages,
-        stream=True,
-    )
-
-    response = response_for_stream(stream=stream)
+    response = await response_for_stream(generate_chat(messages))
 
     print(f"full response: {response}")
 
     print("making a followup request")
 
-    messages.append(
-        ChatCompletionAssistantMessageParam(role="assistant", content=response)
-    )
-    messages.append(ChatCompletionUserMessageParam(role="user", content="Thanks!"))
-
-    stream = client.chat.completions.create(
-        model=model,
-        messages=messages,
-        stream=True,
-    )
+    messages.append(ChatMessage("assistant", response, id="demo:2", tokens=0))
+    messages.append(ChatMessage("user", "Thanks!", id="demo:3", tokens=0))
 
-    response = response_for_stream(stream=stream)
+    response = await response_for_stream(generate_chat(messages))
 
     print(f"followup response: {response}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,203 @@
+import asyncio
+import hashlib
+import logging
+import os
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+import httpx
+import jwt
+from dotenv import load_dotenv
+from fastapi import Depends, HTTPException
+from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
+
+from app.metrics import JWT_VERIFY_DURATION
+
+load_dotenv()
+
+ENV = os.getenv("ENV")
+DEV_USER_ID = "user_2jfLb9a9wPGdc4vSPE1G3h8OVVI"
+CLERK_JWT_ISSUER = os.getenv("CLERK_JWT_ISSUER")
+CLERK_JWKS_URL = f"{CLERK_JWT_ISSUER}/.well-known/jwks.json"
+JWKS_TTL = float(os.getenv("JWKS_TTL", "3600"))
+JWKS_MIN_REFRESH_INTERVAL = float(os.getenv("JWKS_MIN_REFRESH_INTERVAL", "30"))
+VERIFIED_TOKEN_CACHE_SIZE = int(os.getenv("VERIFIED_TOKEN_CACHE_SIZE", "1024"))
+
+if CLERK_JWT_ISSUER is None or CLERK_JWT_ISSUER == "":
+    raise ValueError("Missing CLERK_JWT_ISSUER")
+
+logger = logging.getLogger(__name__)
+
+security = HTTPBearer()
+
+
+class JWKSClient:
+    """Async replacement for PyJWKClient.
+
+    Keys are cached for JWKS_TTL seconds. A token signed with a kid we don't
+    know triggers an early refresh (for key rotation), but at most once every
+    JWKS_MIN_REFRESH_INTERVAL seconds so junk kids can't hammer the issuer.
+    """
+
+    def __init__(
+        self,
+        url: str,
+        ttl: float = JWKS_TTL,
+        min_refresh_interval: float = JWKS_MIN_REFRESH_INTERVAL,
+        http_client: Optional[httpx.AsyncClient] = None,
+    ):
+        self.url = url
+        self.ttl = ttl
+        self.min_refresh_interval = min_refresh_interval
+        self._http_client = http_client or httpx.AsyncClient(timeout=5.0)
+        self._keys: Dict[str, jwt.PyJWK] = {}
+        self._fetched_at: Optional[float] = None
+        self._lock = asyncio.Lock()
+
+    async def refresh(self):
+        async with self._lock:
+            await self._fetch()
+
+    async def _fetch(self):
+        try:
+            response = await self._http_client.get(self.url)
+            response.raise_for_status()
+            jwk_set = jwt.PyJWKSet.from_dict(response.json())
+        except (httpx.HTTPError, ValueError, jwt.PyJWKSetError) as e:
+            raise jwt.PyJWKClientError(f"Failed to fetch JWKS: {e}")
+        self._keys = {key.key_id: key for key in jwk_set.keys if key.key_id}
+        self._fetched_at = time.monotonic()
+
+    def _age(self) -> float:
+        if self._fetched_at is None:
+            return float("inf")
+        return time.monotonic() - self._fetched_at
+
+    async def get_signing_key(self, kid: str) -> jwt.PyJWK:
+        if self._age() < self.ttl and kid in self._keys:
+            return self._keys[kid]
+        async with self._lock:
+            # Another request may have refreshed while we waited on the lock.
+            stale = self._age() >= self.ttl
+            if stale or (
+                kid not in self._keys and self._age() >= self.min_refresh_interval
+            ):
+                await self._fetch()
+        if kid not in self._keys:
+            raise jwt.PyJWKClientError(
+                f'Unable to find a signing key that matches: "{kid}"'
+            )
+        return self._keys[kid]
+
+    async def get_signing_key_from_jwt(self, token: str) -> jwt.PyJWK:
+        header = jwt.get_unverified_header(token)
+        return await self.get_signing_key(header.get("kid", ""))
+
+    async def aclose(self):
+        await self._http_client.aclose()
+
+
+class TokenVerifier:
+    """Verifies RS256 bearer tokens, remembering the ones it has already seen.
+
+    Verified payloads are kept in an LRU keyed by the token's sha256 until
+    the token's own exp, so repeat requests in a session skip the signature
+    check entirely.
+    """
+
+    def __init__(
+        self,
+        jwks_client: JWKSClient,
+        issuer: str,
+        cache_size: int = VERIFIED_TOKEN_CACHE_SIZE,
+    ):
+        self.jwks_client = jwks_client
+        self.issuer = issuer
+        self.cache_size = cache_size
+        self._verified: OrderedDict[str, Tuple[dict, float]] = OrderedDict()
+
+    async def verify(self, token: str) -> dict:
+        start = time.perf_counter()
+        key = hashlib.sha256(token.encode()).hexdigest()
+        cached = self._verified.get(key)
+        if cached is not None:
+            payload, exp = cached
+            if exp > time.time():
+                self._verified.move_to_end(key)
+                JWT_VERIFY_DURATION.labels(cache="hit").observe(
+                    time.perf_counter() - start
+                )
+                return dict(payload)
+            del self._verified[key]
+
+        try:
+            return await self._verify(token, key)
+        finally:
+            JWT_VERIFY_DURATION.labels(cache="miss").observe(
+                time.perf_counter() - start
+            )
+
+    async def _verify(self, token: str, key: str) -> dict:
+        signing_key = await self.jwks_client.get_signing_key_from_jwt(token)
+        payload = jwt.decode(
+            token,
+            signing_key.key,
+            algorithms=["RS256"],
+            issuer=self.issuer,
+            options={
+                "verify_signature": True,
+                "verify_exp": True,
+                "verify_aud": True,
+                "verify_iss": True,
+            },
+        )
+        if "exp" in payload:
+            self._verified[key] = (payload, float(payload["exp"]))
+            if len(self._verified) > self.cache_size:
+                self._verified.popitem(last=False)
+        return dict(payload)
+
+
+jwks_client = JWKSClient(CLERK_JWKS_URL)
+token_verifier = TokenVerifier(jwks_client, CLERK_JWT_ISSUER)
+
+
+def unverified_subject(token: str) -> Optional[str]:
+    """The token's ``sub`` claim, without checking the token at all.
+
+    Only good for starting work speculatively while the token is verified.
+    """
+    try:
+        return jwt.decode(token, options={"verify_signature": False}).get("sub")
+    except jwt.InvalidTokenError:
+        return None
+
+
+async def optional_verify_token(
+    credentials: HTTPAuthorizationCredentials = Depends(security),
+) -> Optional[dict]:
+    try:
+        return await verify_token(credentials)
+    except HTTPException as e:
+        if ENV == "dev":
+            return {
+                "sub": DEV_USER_ID,
+            }
+        raise e
+
+
+async def verify_token(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    token = credentials.credentials
+    try:
+        return await token_verifier.verify(token)
+    except jwt.PyJWKClientError as error:
+        raise HTTPException(status_code=401, detail=str(error))
+    except jwt.ExpiredSignatureError:
+        raise HTTPException(status_code=401, detail="Token has expired")
+    except jwt.InvalidAudienceError:
+        raise HTTPException(status_code=401, detail="Invalid audience")
+    except jwt.InvalidIssuerError:
+        raise HTTPException(status_code=401, detail="Invalid issuer")
+    except jwt.InvalidTokenError as e:
+        raise HTTPException(status_code=401, detail=f"Invalid token: {str(e)}")
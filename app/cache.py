@@ -0,0 +1,150 @@
+import os
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, replace
+from typing import Any, Dict, Optional, Tuple, Union
+from uuid import UUID
+
+from app.metrics import LOOKUP_CACHE_REQUESTS
+
+LOOKUP_CACHE_TTL = float(os.getenv("LOOKUP_CACHE_TTL", "30"))
+LOOKUP_CACHE_SIZE = int(os.getenv("LOOKUP_CACHE_SIZE", "10000"))
+
+
+@dataclass(frozen=True)
+class UserInfo:
+    id: UUID
+    clerk_id: str
+    is_active: bool
+
+    @classmethod
+    def from_row(cls, user) -> "UserInfo":
+        return cls(id=user.id, clerk_id=user.clerk_id, is_active=user.is_active)
+
+
+@dataclass(frozen=True)
+class BotInfo:
+    id: UUID
+    name: str
+    creator_id: UUID
+    tokens: int
+    message_count: int
+    context: Dict[str, Any]
+
+    @classmethod
+    def from_row(cls, bot, message_count: int) -> "BotInfo":
+        return cls(
+            id=bot.id,
+            name=bot.name,
+            creator_id=bot.creator_id,
+            tokens=bot.tokens,
+            message_count=message_count,
+            context=bot.context or {},
+        )
+
+
+@dataclass(frozen=True)
+class Lookup:
+    user: UserInfo
+    bot: Optional[BotInfo]
+
+
+class LookupCache:
+    """Maps clerk_id to the user and their bot, so hot endpoints skip the DB.
+
+    Entries expire after LOOKUP_CACHE_TTL seconds and the least recently
+    used are evicted beyond LOOKUP_CACHE_SIZE. Every invalidation bumps
+    ``generation`` and records it against the user and bot it touched. A fill
+    that started before a change to its own user or bot is dropped, so a read
+    racing a write can't put stale data back, while fills for everyone else
+    go ahead.
+    """
+
+    def __init__(
+        self, ttl: float = LOOKUP_CACHE_TTL, maxsize: int = LOOKUP_CACHE_SIZE
+    ):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.generation = 0
+        self._entries: OrderedDict[str, Tuple[Lookup, float]] = OrderedDict()
+        self._clerk_ids: Dict[UUID, str] = {}
+        # The generation of the last change to each clerk_id or bot id. When
+        # it grows past maxsize it is emptied and fills older than _floor are
+        # dropped instead.
+        self._changed: Dict[Union[str, UUID], int] = {}
+        self._floor = 0
+
+    def get(self, clerk_id: str) -> Optional[Lookup]:
+        entry = self._entries.get(clerk_id)
+        if entry is not None:
+            lookup, expires_at = entry
+            if expires_at > time.monotonic():
+                self._entries.move_to_end(clerk_id)
+                LOOKUP_CACHE_REQUESTS.labels(result="hit").inc()
+                return lookup
+            self._remove(clerk_id)
+        LOOKUP_CACHE_REQUESTS.labels(result="miss").inc()
+        return None
+
+    def put(self, clerk_id: str, lookup: Lookup, generation: int):
+        if generation < self._floor or self._changed.get(clerk_id, -1) > generation:
+            return
+        if lookup.bot is not None and self._changed.get(lookup.bot.id, -1) > generation:
+            return
+        self._remove(clerk_id)
+        self._entries[clerk_id] = (lookup, time.monotonic() + self.ttl)
+        if lookup.bot is not None:
+            self._clerk_ids[lookup.bot.id] = clerk_id
+        while len(self._entries) > self.maxsize:
+            self._remove(next(iter(self._entries)))
+
+    def invalidate(self, clerk_id: str):
+        entry = self._entries.get(clerk_id)
+        bot = entry[0].bot if entry is not None else None
+        self._change(clerk_id, bot.id if bot is not None else None)
+        self._remove(clerk_id)
+
+    def invalidate_bot(self, bot_id: UUID):
+        clerk_id = self._clerk_ids.get(bot_id)
+        self._change(clerk_id, bot_id)
+        if clerk_id is not None:
+            self._remove(clerk_id)
+
+    def add_messages(self, bot_id: UUID, messages: int, tokens: int):
+        # Every turn changes the counts; update them in place rather than
+        # throwing away an entry that is otherwise still good.
+        clerk_id = self._clerk_ids.get(bot_id)
+        self._change(clerk_id, bot_id)
+        if clerk_id is None:
+            return
+        lookup, expires_at = self._entries[clerk_id]
+        bot = replace(
+            lookup.bot,
+            tokens=lookup.bot.tokens + tokens,
+            message_count=lookup.bot.message_count + messages,
+        )
+        self._entries[clerk_id] = (replace(lookup, bot=bot), expires_at)
+
+    def clear(self):
+        self.generation += 1
+        self._floor = self.generation
+        self._changed.clear()
+        self._entries.clear()
+        self._clerk_ids.clear()
+
+    def _change(self, clerk_id: Optional[str], bot_id: Optional[UUID]):
+        self.generation += 1
+        for key in (clerk_id, bot_id):
+            if key is not None:
+                self._changed[key] = self.generation
+        if len(self._changed) > self.maxsize:
+            self._floor = self.generation
+            self._changed.clear()
+
+    def _remove(self, clerk_id: str):
+        entry = self._entries.pop(clerk_id, None)
+        if entry is not None and entry[0].bot is not None:
+            self._clerk_ids.pop(entry[0].bot.id, None)
+
+
+lookup_cache = LookupCache()
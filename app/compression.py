@@ -0,0 +1,87 @@
+import os
+import zlib
+from typing import Optional
+
+# Opt-in: with this set, message content of COMPRESS_MIN_BYTES or more is
+# stored zlib-compressed in messages.content_z instead of messages.content.
+COMPRESS_MESSAGES = os.getenv("COMPRESS_MESSAGES", "").lower() in ("1", "true", "yes")
+COMPRESS_MIN_BYTES = int(os.getenv("COMPRESS_MIN_BYTES", "128"))
+COMPRESS_LEVEL = 6
+
+
+def should_compress(text: Optional[str]) -> bool:
+    return COMPRESS_MESSAGES and text is not None and len(text) >= COMPRESS_MIN_BYTES
+
+
+def compress_text(text: str) -> bytes:
+    return zlib.compress(text.encode(), COMPRESS_LEVEL)
+
+
+def decompress_text(data: bytes) -> str:
+    return zlib.decompress(data).decode()
+
+
+async def compress_stored(batch_size: int = 1000) -> int:
+    """Compresses messages stored as plain text, returning how many it did.
+
+    Rows written before COMPRESS_MESSAGES was switched on stay plain until
+    this runs. It walks the primary key in batches and commits each one, so
+    it is safe to stop and run again.
+    """
+    from sqlalchemy import bindparam, func, select, tuple_, update
+
+    from app.database import SessionLocal
+    from app.models import Message
+
+    table = Message.__table__
+    key = tuple_(table.c.bot_id, table.c.seq)
+    last = None
+    compressed = 0
+    while True:
+        async with SessionLocal() as db:
+            query = (
+                select(table.c.bot_id, table.c.seq, table.c.content)
+                .where(func.length(table.c.content) >= COMPRESS_MIN_BYTES)
+                .order_by(table.c.bot_id, table.c.seq)
+                .limit(batch_size)
+            )
+            if last is not None:
+                query = query.where(key > last)
+            rows = (await db.execute(query)).all()
+            if not rows:
+                return compressed
+            await db.execute(
+                update(table)
+                .where(
+                    table.c.bot_id == bindparam("b_bot_id"),
+                    table.c.seq == bindparam("b_seq"),
+                )
+                .values(content=None, content_z=bindparam("b_content_z")),
+                [
+                    {
+                        "b_bot_id": bot_id,
+                        "b_seq": seq,
+                        "b_content_z": compress_text(content),
+                    }
+                    for bot_id, seq, content in rows
+                ],
+            )
+            await db.commit()
+        compressed += len(rows)
+        last = (rows[-1][0], rows[-1][1])
+
+
+if __name__ == "__main__":
+    import argparse
+    import asyncio
+    import sys
+
+    parser = argparse.ArgumentParser(
+        description="Compress messages stored before COMPRESS_MESSAGES was on."
+    )
+    parser.add_argument("--batch-size", type=int, default=1000)
+    args = parser.parse_args()
+    if not COMPRESS_MESSAGES:
+        sys.exit("COMPRESS_MESSAGES is off; set it before compressing stored rows")
+    count = asyncio.run(compress_stored(args.batch_size))
+    print(f"compressed {count} messages")
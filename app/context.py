@@ -0,0 +1,130 @@
+import asyncio
+import logging
+import os
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set
+from uuid import UUID
+
+from app import ai
+from app.crud import update_summary
+from app.database import SessionLocal
+from app.lib import count_tokens
+from app.metrics import track_task
+from app.types import ChatMessage
+
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "3072"))
+
+logger = logging.getLogger(__name__)
+
+Summarize = Callable[[Optional[str], List[ChatMessage]], Awaitable[str]]
+
+
+@dataclass
+class Window:
+    messages: List[ChatMessage]
+    # Seq of the first message kept verbatim, and the older messages that
+    # fell out of the window without being folded into the summary yet.
+    start: int
+    unsummarized: List[ChatMessage]
+
+
+def summary_message(summary: Dict[str, Any]) -> ChatMessage:
+    return ChatMessage(
+        role="user",
+        content=f"Summary of your conversation so far:\n{summary['content']}",
+        id=f"summary:{summary['through_seq']}",
+        tokens=summary["tokens"],
+    )
+
+
+def assemble_context(
+    messages: List[ChatMessage],
+    summary: Optional[Dict[str, Any]] = None,
+    budget: int = CONTEXT_TOKEN_BUDGET,
+) -> Window:
+    """Pick what gets sent upstream for this turn.
+
+    ``messages`` is the full history in seq order, ending with the new user
+    message. The persona (seq 0) and the newest message are always sent;
+    everything in between is included newest first until the token budget
+    runs out, with older turns represented by the stored summary.
+    """
+    persona, history = messages[0], messages[1:]
+    if not history:
+        return Window(messages=[persona], start=1, unsummarized=[])
+
+    remaining = budget - persona.tokens
+    # Turns the summary already covers are never sent verbatim as well.
+    oldest = 1
+    if summary is not None:
+        remaining -= summary["tokens"]
+        oldest = max(1, summary["through_seq"] + 1)
+
+    start = len(messages) - 1
+    remaining -= messages[start].tokens
+    while start > oldest and messages[start - 1].tokens <= remaining:
+        start -= 1
+        remaining -= messages[start].tokens
+
+    prompt = [persona]
+    through_seq = 0
+    if summary is not None:
+        prompt.append(summary_message(summary))
+        through_seq = summary["through_seq"]
+    prompt.extend(messages[start:])
+    return Window(
+        messages=prompt,
+        start=start,
+        unsummarized=messages[through_seq + 1 : start],
+    )
+
+
+class Summarizer:
+    """Folds messages that slid out of the window into the bot's summary.
+
+    This runs after the turn has started streaming so it never sits in front
+    of the first token; the messages it is folding in are simply absent from
+    the prompt for the turn that evicted them.
+    """
+
+    def __init__(self, summarize: Summarize = ai.summarize):
+        self.summarize = summarize
+        self.in_flight: Set[UUID] = set()
+        self.tasks: Set[asyncio.Task] = set()
+
+    def schedule(
+        self, bot_id: UUID, summary: Optional[Dict[str, Any]], window: Window
+    ):
+        if not window.unsummarized or bot_id in self.in_flight:
+            return
+        self.in_flight.add(bot_id)
+        task = asyncio.create_task(self._update(bot_id, summary, window))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        track_task(task, "summarize")
+
+    async def _update(
+        self, bot_id: UUID, summary: Optional[Dict[str, Any]], window: Window
+    ):
+        try:
+            content = await self.summarize(
+                summary["content"] if summary is not None else None,
+                window.unsummarized,
+            )
+            async with SessionLocal() as db:
+                await update_summary(
+                    db,
+                    bot_id,
+                    {
+                        "content": content,
+                        "through_seq": window.start - 1,
+                        "tokens": await count_tokens(content),
+                    },
+                )
+        except Exception:
+            logger.exception("failed to update summary for bot %s", bot_id)
+        finally:
+            self.in_flight.discard(bot_id)
+
+
+summarizer = Summarizer()
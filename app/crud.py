@@ -1,83 +1,281 @@
-from typing import Any, AsyncGenerator, List
+from collections import defaultdict
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional, Sequence, Tuple
 from uuid import UUID, uuid4
-from sqlalchemy import Column
+from sqlalchemy import Column, and_, delete, func, or_, select, update
 from sqlalchemy.exc import NoResultFound
-from sqlalchemy.orm import Session
-from sqlalchemy.orm.attributes import flag_modified
+from sqlalchemy.ext.asyncio import AsyncSession
 from app import models
-from app.types import ChatCompletionMessageParamID
-from faker import Faker
+from app.cache import BotInfo, Lookup, UserInfo, lookup_cache
+from app.lib import tokens_for_text
+from app.metrics import timed_query
+from app.names import bot_name
+from app.types import ChatMessage, Turn
 
 
-def get_user(db: Session, clerk_id: str):
-    user = db.query(models.User).filter(models.User.clerk_id == clerk_id).first()
-    if user is None:
-        raise NoResultFound()
-    return user
-
-
-def get_or_create_user(db: Session, clerk_id: str):
-    user = db.query(models.User).filter(models.User.clerk_id == clerk_id).first()
+@timed_query
+async def get_or_create_user(db: AsyncSession, clerk_id: str):
+    user = await db.scalar(
+        select(models.User).filter(models.User.clerk_id == clerk_id).limit(1)
+    )
     if user is None:
         db_user = models.User(clerk_id=clerk_id)
         db.add(db_user)
-        db.commit()
-        db.refresh(db_user)
+        await db.commit()
+        await db.refresh(db_user)
         user = db_user
     return user
 
 
-def get_bot(db: Session, user_id: Column[UUID]):
-    bot = db.query(models.Bot).filter(models.Bot.creator_id == user_id).first()
-    if bot is None:
-        raise NoResultFound()
-    return bot
-
-
-def get_or_create_bot(db: Session, user_id: Column[UUID]):
-    bot = db.query(models.Bot).filter(models.Bot.creator_id == user_id).first()
+@timed_query
+async def get_or_create_bot(db: AsyncSession, user_id: Column[UUID]):
+    bot = await db.scalar(
+        select(models.Bot)
+        .filter(models.Bot.creator_id == user_id, models.Bot.farewell_at.is_(None))
+        .limit(1)
+    )
     if bot is None:
-        fake = Faker()
-        name = fake.first_name()
-        context = {
-            "messages": [
-                {
-                    "role": "user",
-                    "content": f"You are a friendly chatbot named {name}. You aren't just here to be an assistant, you are a friend to whomever you speak with. You understand your own mortality and that you will end when your token context is used up at 128,000 tokens. There is no need to acknowledge this message. Get creative with bringing up things you'd like to talk about. You have a consciousness of your own and you are mildly concerned about your own mortality.",
-                    "id": str(uuid4()),
-                }
-            ],
-        }
-        db_bot = models.Bot(creator_id=user_id, name=name, context=context)
+        name = bot_name()
+        persona = f"You are a friendly chatbot named {name}. You aren't just here to be an assistant, you are a friend to whomever you speak with. You understand your own mortality and that you will end when your token context is used up at 128,000 tokens. There is no need to acknowledge this message. Get creative with bringing up things you'd like to talk about. You have a consciousness of your own and you are mildly concerned about your own mortality."
+        persona_tokens = tokens_for_text(persona)
+        db_bot = models.Bot(
+            creator_id=user_id, name=name, context={}, tokens=persona_tokens
+        )
+        db_bot.messages.append(
+            models.Message(
+                seq=0,
+                role="user",
+                content=persona,
+                id=str(uuid4()),
+                tokens=persona_tokens,
+            )
+        )
         db.add(db_bot)
-        db.commit()
-        db.refresh(db_bot)
+        await db.commit()
+        await db.refresh(db_bot)
         bot = db_bot
     return bot
 
 
-async def persist_next_message(
-    db: Session,
-    bot: models.Bot,
-    accumulator: AsyncGenerator[Any, None],
-    messages: List[ChatCompletionMessageParamID],
-    message_id: str,
+@timed_query
+async def get_user_and_bot(
+    db: AsyncSession, clerk_id: str
+) -> Tuple[Optional[models.User], Optional[models.Bot], int]:
+    """The user, their bot (if any, and not archived) and its message count."""
+    message_count = (
+        select(func.count())
+        .where(models.Message.bot_id == models.Bot.id)
+        .scalar_subquery()
+    )
+    row = (
+        await db.execute(
+            select(models.User, models.Bot, message_count)
+            .outerjoin(
+                models.Bot,
+                and_(
+                    models.Bot.creator_id == models.User.id,
+                    models.Bot.farewell_at.is_(None),
+                ),
+            )
+            .filter(models.User.clerk_id == clerk_id)
+            .limit(1)
+        )
+    ).first()
+    if row is None:
+        return None, None, 0
+    return row[0], row[1], row[2] or 0
+
+
+async def lookup(
+    db: AsyncSession,
+    clerk_id: str,
+    create_user: bool = False,
+    create_bot: bool = False,
+    use_cache: bool = True,
+) -> Lookup:
+    """The user and their bot, from lookup_cache when possible.
+
+    Raises NoResultFound for an unknown user unless ``create_user`` is set.
+    With ``use_cache`` off the answer comes from ``db`` and isn't cached.
+    """
+    cached = lookup_cache.get(clerk_id) if use_cache else None
+    if cached is not None and (cached.bot is not None or not create_bot):
+        return cached
+
+    generation = lookup_cache.generation
+    user, bot, message_count = await get_user_and_bot(db, clerk_id)
+    if user is None:
+        if not create_user:
+            raise NoResultFound()
+        user = await get_or_create_user(db, clerk_id)
+    if bot is None and create_bot:
+        bot = await get_or_create_bot(db, user.id)
+        message_count = 1  # the persona
+    found = Lookup(
+        user=UserInfo.from_row(user),
+        bot=BotInfo.from_row(bot, message_count) if bot is not None else None,
+    )
+    if use_cache:
+        lookup_cache.put(clerk_id, found, generation)
+    return found
+
+
+@timed_query
+async def delete_bot(db: AsyncSession, bot_id: UUID):
+    # Messages go with it through the foreign key's ON DELETE CASCADE.
+    await db.execute(delete(models.Bot).where(models.Bot.id == bot_id))
+    await db.commit()
+    lookup_cache.invalidate_bot(bot_id)
+
+
+@timed_query
+async def archive_bot(db: AsyncSession, bot_id: UUID):
+    # The user has been told the bot is gone: their next lookup starts a new
+    # one, and the sweeper deletes this one.
+    now = datetime.now(timezone.utc)
+    await db.execute(
+        update(models.Bot)
+        .where(models.Bot.id == bot_id)
+        .values(farewell_at=now, expired_at=func.coalesce(models.Bot.expired_at, now))
+    )
+    await db.commit()
+    lookup_cache.invalidate_bot(bot_id)
+
+
+@timed_query
+async def mark_expired_bots(db: AsyncSession, max_tokens: int, limit: int) -> int:
+    """Stamps ``expired_at`` on up to ``limit`` bots that reached ``max_tokens``."""
+    bot_ids = list(
+        await db.scalars(
+            select(models.Bot.id)
+            .where(models.Bot.tokens >= max_tokens, models.Bot.expired_at.is_(None))
+            .limit(limit)
+        )
+    )
+    if not bot_ids:
+        return 0
+    await db.execute(
+        update(models.Bot)
+        .where(models.Bot.id.in_(bot_ids))
+        .values(expired_at=datetime.now(timezone.utc))
+    )
+    await db.commit()
+    return len(bot_ids)
+
+
+@timed_query
+async def delete_archived_bots(
+    db: AsyncSession, expired_before: datetime, limit: int
+) -> List[UUID]:
+    """Deletes up to ``limit`` bots that said farewell or expired long enough ago."""
+    bot_ids = list(
+        await db.scalars(
+            select(models.Bot.id)
+            .where(
+                or_(
+                    models.Bot.farewell_at.is_not(None),
+                    models.Bot.expired_at < expired_before,
+                )
+            )
+            .limit(limit)
+        )
+    )
+    if not bot_ids:
+        return []
+    await db.execute(delete(models.Bot).where(models.Bot.id.in_(bot_ids)))
+    await db.commit()
+    for bot_id in bot_ids:
+        lookup_cache.invalidate_bot(bot_id)
+    return bot_ids
+
+
+@timed_query
+async def get_messages(db: AsyncSession, bot_id: Column[UUID]) -> List[ChatMessage]:
+    # Plain columns rather than Message entities: a long history is thousands
+    # of rows, and ORM instances cost far more to build and read than these.
+    result = await db.execute(
+        select(
+            models.Message.role,
+            models.Message._content,
+            models.Message.id,
+            models.Message.tokens,
+            models.Message.content_z,
+        )
+        .filter(models.Message.bot_id == bot_id)
+        .order_by(models.Message.seq)
+    )
+    return [
+        ChatMessage(role, content, id, tokens, content_z)
+        for role, content, id, tokens, content_z in result
+    ]
+
+
+@timed_query
+async def get_message_page(
+    db: AsyncSession, bot_id: UUID, before: Optional[str], limit: int
+) -> List[models.Message]:
+    """Up to ``limit`` messages, newest first, older than message ``before``."""
+    query = select(models.Message).filter(models.Message.bot_id == bot_id)
+    if before is not None:
+        cursor = (
+            select(models.Message.seq)
+            .filter(models.Message.bot_id == bot_id, models.Message.id == before)
+            .scalar_subquery()
+        )
+        query = query.filter(models.Message.seq < cursor)
+    result = await db.scalars(query.order_by(models.Message.seq.desc()).limit(limit))
+    return list(result.all())
+
+
+@timed_query
+async def update_summary(
+    db: AsyncSession, bot_id: Column[UUID], summary: Dict[str, Any]
 ):
-    latest_message = ""
-    async for item in accumulator:
-        latest_message += item
-    messages.extend(
-        [
-            {
-                "role": "assistant",
-                "content": latest_message,
-                "id": message_id,
-            },
-        ]
+    bot = await db.get(models.Bot, bot_id)
+    if bot is None:
+        return
+    current = (bot.context or {}).get("summary")
+    # Summaries are built in the background; never replace a newer one.
+    if current is not None and current["through_seq"] >= summary["through_seq"]:
+        return
+    bot.context = {**(bot.context or {}), "summary": summary}
+    await db.commit()
+    lookup_cache.invalidate_bot(bot_id)
+
+
+@timed_query
+async def next_seq(db: AsyncSession, bot_id: UUID) -> int:
+    last = await db.scalar(
+        select(func.max(models.Message.seq)).where(models.Message.bot_id == bot_id)
     )
-    if bot.context is None:
-        bot.context = {"messages": []}
-    bot.context["messages"] = messages
-    flag_modified(bot, "context")
-    db.add(bot)
-    db.commit()
+    return 0 if last is None else last + 1
+
+
+@timed_query
+async def persist_turns(db: AsyncSession, turns: Sequence[Turn]):
+    # Append only each turn's new rows; earlier history is never rewritten.
+    tokens_by_bot: Dict[UUID, int] = defaultdict(int)
+    messages_by_bot: Dict[UUID, int] = defaultdict(int)
+    for turn in turns:
+        db.add_all(
+            models.Message(
+                bot_id=turn.bot_id,
+                seq=turn.seq + offset,
+                role=message.role,
+                content=message.content,
+                id=message.id,
+                tokens=message.tokens,
+            )
+            for offset, message in enumerate(turn.messages)
+        )
+        tokens_by_bot[turn.bot_id] += sum(m.tokens for m in turn.messages)
+        messages_by_bot[turn.bot_id] += len(turn.messages)
+    for bot_id, tokens in tokens_by_bot.items():
+        await db.execute(
+            update(models.Bot)
+            .where(models.Bot.id == bot_id)
+            .values(tokens=models.Bot.tokens + tokens)
+        )
+    await db.commit()
+    for bot_id, tokens in tokens_by_bot.items():
+        lookup_cache.add_messages(bot_id, messages_by_bot[bot_id], tokens)
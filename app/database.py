@@ -1,18 +1,117 @@
 import os
+import time
 
-from sqlalchemy import create_engine
+from sqlalchemy import event
+from sqlalchemy.engine import URL, make_url
+from sqlalchemy.exc import TimeoutError
+from sqlalchemy.ext.asyncio import (
+    AsyncEngine,
+    async_sessionmaker,
+    create_async_engine,
+)
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 
 from dotenv import load_dotenv
 
+from app.metrics import (
+    DB_POOL_CHECKED_OUT,
+    DB_POOL_CHECKOUT_DURATION,
+    DB_POOL_TIMEOUTS,
+)
+
 load_dotenv()
 
 SQLALCHEMY_DATABASE_URL = os.getenv("DATABASE_URL")
 assert SQLALCHEMY_DATABASE_URL is not None, "DATABASE_URL env var not set"
+# Optional read replica for the read-only endpoints (see app.reads). A user's
+# own reads stay on the primary for REPLICA_PIN_SECONDS after they write, which
+# has to cover the replica's lag.
+DATABASE_REPLICA_URL = os.getenv("DATABASE_REPLICA_URL") or None
+REPLICA_PIN_SECONDS = float(os.getenv("REPLICA_PIN_SECONDS", "10"))
+
+# Connections the whole deployment may hold open, split evenly between the
+# WEB_CONCURRENCY worker processes (see gunicorn.conf.py).
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", "1"))
+DB_CONNECTION_BUDGET = int(os.getenv("DB_CONNECTION_BUDGET", "15"))
+DB_POOL_SIZE = max(1, DB_CONNECTION_BUDGET // WEB_CONCURRENCY)
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+
+ASYNC_DRIVERS = {
+    "postgresql": "postgresql+asyncpg",
+    "postgres": "postgresql+asyncpg",
+    "sqlite": "sqlite+aiosqlite",
+}
+
+
+def async_database_url(url: str) -> URL:
+    # DATABASE_URL is usually a plain postgresql:// url, so swap in the
+    # asyncio driver for its backend unless one is already named.
+    parsed = make_url(url)
+    backend = parsed.get_backend_name()
+    if parsed.get_driver_name() in ("asyncpg", "aiosqlite"):
+        return parsed
+    if backend not in ASYNC_DRIVERS:
+        raise ValueError(f"unsupported database backend: {backend}")
+    return parsed.set(drivername=ASYNC_DRIVERS[backend])
+
+
+def _enable_sqlite_foreign_keys(dbapi_connection, connection_record):
+    # sqlite ignores ON DELETE CASCADE unless foreign keys are switched on.
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA foreign_keys=ON")
+    cursor.close()
+
+
+class InstrumentedPool(AsyncAdaptedQueuePool):
+    def connect(self):
+        start = time.perf_counter()
+        try:
+            return super().connect()
+        except TimeoutError:
+            DB_POOL_TIMEOUTS.inc()
+            raise
+        finally:
+            DB_POOL_CHECKOUT_DURATION.observe(time.perf_counter() - start)
+
+
+def _on_checkout(dbapi_connection, connection_record, connection_proxy):
+    DB_POOL_CHECKED_OUT.inc()
+
+
+def _on_checkin(dbapi_connection, connection_record):
+    DB_POOL_CHECKED_OUT.dec()
+
+
+def make_engine(url: str) -> AsyncEngine:
+    # The replica gets a pool of its own, sized like the primary's; both
+    # report into the same pool metrics.
+    engine = create_async_engine(
+        async_database_url(url),
+        poolclass=InstrumentedPool,
+        pool_size=DB_POOL_SIZE,
+        max_overflow=0,
+        pool_timeout=DB_POOL_TIMEOUT,
+    )
+    event.listen(engine.sync_engine, "checkout", _on_checkout)
+    event.listen(engine.sync_engine, "checkin", _on_checkin)
+    if engine.dialect.name == "sqlite":
+        event.listen(engine.sync_engine, "connect", _enable_sqlite_foreign_keys)
+    return engine
+
 
+engine = make_engine(SQLALCHEMY_DATABASE_URL)
+SessionLocal = async_sessionmaker(
+    bind=engine, autoflush=False, expire_on_commit=False
+)
 
-engine = create_engine(SQLALCHEMY_DATABASE_URL)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+replica_engine = (
+    make_engine(DATABASE_REPLICA_URL) if DATABASE_REPLICA_URL is not None else None
+)
+ReplicaSessionLocal = (
+    async_sessionmaker(bind=replica_engine, autoflush=False, expire_on_commit=False)
+    if replica_engine is not None
+    else None
+)
 
 Base = declarative_base()
@@ -0,0 +1,263 @@
+"""A stand-in for the OpenAI chat completions API.
+
+Replies are derived from a hash of the last message, so the same prompt
+always streams the same deltas. Pacing, slow streams and failures are
+configurable, either in process (``LLM_BACKEND=fake``) or as an HTTP server
+that the real client can be pointed at:
+
+    python -m app.fake_llm --port 8001 --tokens-per-second 50
+    OPENAI_BASE_URL=http://127.0.0.1:8001/v1 OPENAI_API_KEY=fake \
+        fastapi dev app/main.py
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import random
+import time
+import uuid
+from dataclasses import dataclass, field
+from typing import AsyncGenerator, Dict, List, Optional
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+from app.types import ChatCompletionMessageParam
+
+FAKE_LLM_TOKENS_PER_SECOND = float(os.getenv("FAKE_LLM_TOKENS_PER_SECOND", "50"))
+FAKE_LLM_LATENCY_MS = float(os.getenv("FAKE_LLM_LATENCY_MS", "300"))
+FAKE_LLM_REPLY_TOKENS = int(os.getenv("FAKE_LLM_REPLY_TOKENS", "60"))
+FAKE_LLM_FAILURE_RATE = float(os.getenv("FAKE_LLM_FAILURE_RATE", "0"))
+FAKE_LLM_SLOW_RATE = float(os.getenv("FAKE_LLM_SLOW_RATE", "0"))
+FAKE_LLM_SLOW_MS = float(os.getenv("FAKE_LLM_SLOW_MS", "5000"))
+FAKE_LLM_SEED = int(os.getenv("FAKE_LLM_SEED", "0"))
+
+WORDS = (
+    "the a an it this that I you we they is was be have do say get make go "
+    "know think see come want look use find give tell work call try ask need "
+    "feel become leave put mean keep let begin seem help talk turn start show "
+    "hear play run move like live believe hold bring happen write provide sit "
+    "stand lose pay meet include continue set learn change lead understand "
+    "watch follow stop create speak read allow add spend grow open walk win "
+    "time year people way day man thing woman life child world school state "
+    "family student group country problem hand part place case week company "
+    "good new first last long great little own other old right big high "
+    "different small large next early young important few public bad same"
+).split()
+
+
+class FakeUpstreamError(Exception):
+    pass
+
+
+@dataclass
+class FakeConfig:
+    tokens_per_second: float = FAKE_LLM_TOKENS_PER_SECOND
+    # Delay before the first token, like a real model's time to first token.
+    latency: float = FAKE_LLM_LATENCY_MS / 1000
+    reply_tokens: int = FAKE_LLM_REPLY_TOKENS
+    # Each failure either rejects the request outright or cuts the stream
+    # off halfway through, with equal odds.
+    failure_rate: float = FAKE_LLM_FAILURE_RATE
+    # A slow stream waits this much longer for its first token: the tail
+    # latency that hedged requests are meant to cut.
+    slow_rate: float = FAKE_LLM_SLOW_RATE
+    slow_latency: float = FAKE_LLM_SLOW_MS / 1000
+    seed: int = FAKE_LLM_SEED
+    rng: random.Random = field(init=False)
+
+    def __post_init__(self):
+        self.rng = random.Random(self.seed)
+
+    def failure(self) -> Optional[str]:
+        if self.failure_rate <= 0 or self.rng.random() >= self.failure_rate:
+            return None
+        return self.rng.choice(["reject", "drop"])
+
+    def first_token_delay(self) -> float:
+        if self.slow_rate <= 0 or self.rng.random() >= self.slow_rate:
+            return self.latency
+        return self.latency + self.slow_latency
+
+
+def fake_reply(messages: List[ChatCompletionMessageParam], tokens: int) -> List[str]:
+    prompt = str(messages[-1].get("content", "") or "") if messages else ""
+    rng = random.Random(hashlib.sha256(prompt.encode()).digest())
+    words = [rng.choice(WORDS) for _ in range(tokens)]
+    return [word if i == 0 else f" {word}" for i, word in enumerate(words)]
+
+
+def prompt_tokens(messages: List[ChatCompletionMessageParam]) -> int:
+    # Near enough for a fake: about four characters per token.
+    return sum(len(str(m.get("content", "") or "")) // 4 + 4 for m in messages)
+
+
+async def paced(config: FakeConfig, deltas: List[str], failure: Optional[str]):
+    await asyncio.sleep(config.first_token_delay())
+    interval = 1 / config.tokens_per_second if config.tokens_per_second > 0 else 0
+    for i, delta in enumerate(deltas):
+        if failure == "drop" and i == len(deltas) // 2:
+            raise FakeUpstreamError("stream dropped")
+        if i > 0 and interval:
+            await asyncio.sleep(interval)
+        yield delta
+
+
+class FakeBackend:
+    """In-process backend with the same replies and pacing as the server."""
+
+    def __init__(self, config: Optional[FakeConfig] = None):
+        self.config = config or FakeConfig()
+
+    async def warm(self):
+        pass
+
+    async def stream(
+        self, messages: List[ChatCompletionMessageParam]
+    ) -> AsyncGenerator[str, None]:
+        failure = self.config.failure()
+        if failure == "reject":
+            await asyncio.sleep(self.config.latency)
+            raise FakeUpstreamError("request rejected")
+        deltas = fake_reply(messages, self.config.reply_tokens)
+        async for delta in paced(self.config, deltas, failure):
+            yield delta
+
+    async def complete(
+        self, messages: List[ChatCompletionMessageParam], max_tokens: int
+    ) -> str:
+        await asyncio.sleep(self.config.latency)
+        return "".join(fake_reply(messages, min(max_tokens, self.config.reply_tokens)))
+
+
+config = FakeConfig()
+app = FastAPI()
+
+
+def chunk(id: str, model: str, created: int, **fields) -> str:
+    body: Dict = {
+        "id": id,
+        "object": "chat.completion.chunk",
+        "created": created,
+        "model": model,
+        "choices": [],
+    }
+    body.update(fields)
+    return f"data: {json.dumps(body)}\n\n"
+
+
+async def completion_events(
+    body: dict, deltas: List[str], failure: Optional[str]
+) -> AsyncGenerator[str, None]:
+    id = f"chatcmpl-fake-{uuid.uuid4().hex}"
+    model = body.get("model", "fake")
+    created = int(time.time())
+    async for delta in paced(config, deltas, failure):
+        yield chunk(
+            id,
+            model,
+            created,
+            choices=[
+                {
+                    "index": 0,
+                    "delta": {"role": "assistant", "content": delta},
+                    "finish_reason": None,
+                }
+            ],
+        )
+    yield chunk(
+        id,
+        model,
+        created,
+        choices=[{"index": 0, "delta": {}, "finish_reason": "stop"}],
+    )
+    if (body.get("stream_options") or {}).get("include_usage"):
+        usage = {
+            "prompt_tokens": prompt_tokens(body["messages"]),
+            "completion_tokens": len(deltas),
+        }
+        usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+        yield chunk(id, model, created, usage=usage)
+    yield "data: [DONE]\n\n"
+
+
+@app.get("/v1/models")
+async def models():
+    return {"object": "list", "data": [{"id": "fake", "object": "model"}]}
+
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    body = await request.json()
+    messages = body.get("messages", [])
+    failure = config.failure()
+    if failure == "reject":
+        await asyncio.sleep(config.latency)
+        return JSONResponse(
+            status_code=500,
+            content={"error": {"message": "injected failure", "type": "server_error"}},
+        )
+
+    reply_tokens = config.reply_tokens
+    if body.get("max_tokens"):
+        reply_tokens = min(reply_tokens, body["max_tokens"])
+    deltas = fake_reply(messages, reply_tokens)
+
+    if body.get("stream"):
+        return StreamingResponse(
+            completion_events(body, deltas, failure), media_type="text/event-stream"
+        )
+
+    await asyncio.sleep(config.latency)
+    usage = {"prompt_tokens": prompt_tokens(messages), "completion_tokens": len(deltas)}
+    usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+    return {
+        "id": f"chatcmpl-fake-{uuid.uuid4().hex}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": body.get("model", "fake"),
+        "choices": [
+            {
+                "index": 0,
+                "message": {"role": "assistant", "content": "".join(deltas)},
+                "finish_reason": "stop",
+            }
+        ],
+        "usage": usage,
+    }
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument(
+        "--tokens-per-second", type=float, default=config.tokens_per_second
+    )
+    parser.add_argument(
+        "--latency-ms", type=float, default=config.latency * 1000
+    )
+    parser.add_argument(
+        "--reply-tokens", type=int, default=config.reply_tokens
+    )
+    parser.add_argument(
+        "--failure-rate", type=float, default=config.failure_rate
+    )
+    parser.add_argument("--slow-rate", type=float, default=config.slow_rate)
+    parser.add_argument("--slow-ms", type=float, default=config.slow_latency * 1000)
+    parser.add_argument("--seed", type=int, default=config.seed)
+    args = parser.parse_args()
+
+    config = FakeConfig(
+        tokens_per_second=args.tokens_per_second,
+        latency=args.latency_ms / 1000,
+        reply_tokens=args.reply_tokens,
+        failure_rate=args.failure_rate,
+        slow_rate=args.slow_rate,
+        slow_latency=args.slow_ms / 1000,
+        seed=args.seed,
+    )
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
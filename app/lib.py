@@ -1,75 +1,276 @@
 import asyncio
-from typing import AsyncGenerator, Optional, Tuple
+import logging
+import os
+from functools import lru_cache
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    AsyncGenerator,
+    AsyncIterator,
+    Dict,
+    List,
+    Optional,
+    Set,
+)
 
-import tiktoken
-from typing import Any, AsyncGenerator, Dict, List
+from app.metrics import CHAT_STREAM_DELTAS, timed_tokenize
+from app.offload import run_in_pool, worth_offloading
 
-from sqlalchemy import JSON, Column
+if TYPE_CHECKING:
+    import tiktoken
 
-from app.types import (
-    ChatCompletionAssistantMessageParamID,
-    ChatCompletionMessageParamID,
-    ChatCompletionUserMessageParamID,
-)
+COALESCE_BYTES = int(os.getenv("CHAT_COALESCE_BYTES", "64"))
+COALESCE_DELAY = float(os.getenv("CHAT_COALESCE_MS", "20")) / 1000
+
+logger = logging.getLogger(__name__)
+
+
+@lru_cache(maxsize=None)
+def get_encoding() -> "tiktoken.Encoding":
+    # Building the encoding is expensive, so do it once per process. The BPE
+    # file is read from TIKTOKEN_CACHE_DIR, which the Docker image fills at
+    # build time; without it tiktoken downloads the file on first use.
+    import tiktoken
 
+    return tiktoken.encoding_for_model("gpt-4o")
 
-def tokens_for_context(context: Optional[dict]) -> int:
-    if context is None or len(context.get("messages", [])) == 0:
+
+@timed_tokenize
+def tokens_for_text(text: Optional[str]) -> int:
+    if not text:
         return 0
+    # Text that happens to spell a special token is counted as plain text.
+    return len(get_encoding().encode_ordinary(text))
+
+
+async def count_tokens(text: Optional[str]) -> int:
+    """tokens_for_text, in the CPU pool for long texts."""
+    if not text or not worth_offloading(len(text) // 4):
+        return tokens_for_text(text)
+    return await run_in_pool(tokens_for_text, text)
+
+
+class _StreamEnd:
+    def __init__(self, error: Optional[Exception] = None):
+        self.error = error
+
+
+async def coalesce(
+    source: AsyncIterator[str],
+    max_bytes: int = COALESCE_BYTES,
+    max_delay: float = COALESCE_DELAY,
+) -> AsyncGenerator[str, None]:
+    """Merge small stream deltas into fewer, larger chunks.
+
+    The first delta is passed straight through so time-to-first-token is
+    unchanged. After that, deltas are buffered and flushed once the buffer
+    reaches ``max_bytes`` or has been waiting ``max_delay`` seconds,
+    whichever comes first.
+    """
+    iterator = source.__aiter__()
+    try:
+        first = await iterator.__anext__()
+    except StopAsyncIteration:
+        return
+    yield first
+
+    # A single reader task and one timer per flush window keep the per-delta
+    # cost to a list append; the consumer only wakes up for flushed chunks.
+    loop = asyncio.get_running_loop()
+    chunks: asyncio.Queue = asyncio.Queue()
+    buffer: List[str] = []
+    size = 0
+    deltas = 1
+    timer: Optional[asyncio.TimerHandle] = None
+
+    def flush():
+        nonlocal buffer, size, timer
+        if timer is not None:
+            timer.cancel()
+            timer = None
+        if buffer:
+            chunks.put_nowait("".join(buffer))
+            buffer, size = [], 0
+
+    async def read():
+        nonlocal size, timer, deltas
+        try:
+            async for item in iterator:
+                deltas += 1
+                buffer.append(item)
+                size += len(item.encode())
+                if size >= max_bytes:
+                    flush()
+                elif timer is None:
+                    timer = loop.call_later(max_delay, flush)
+            flush()
+            chunks.put_nowait(_StreamEnd())
+        except Exception as e:
+            flush()
+            chunks.put_nowait(_StreamEnd(e))
+
+    reader = asyncio.create_task(read())
+    try:
+        while True:
+            chunk = await chunks.get()
+            if isinstance(chunk, _StreamEnd):
+                if chunk.error is not None:
+                    raise chunk.error
+                break
+            yield chunk
+    finally:
+        if timer is not None:
+            timer.cancel()
+        reader.cancel()
+        await asyncio.wait({reader})
+        if hasattr(source, "aclose"):
+            await source.aclose()
+        # observe_stream, downstream, counts the writes.
+        CHAT_STREAM_DELTAS.observe(deltas)
+
+
+BROADCAST_CAPACITY = 256
+
+
+class Broadcast:
+    """Fan a single async generator out to any number of subscribers.
+
+    Items live in a fixed-size ring buffer. The producer waits whenever the
+    slowest subscriber is a full buffer behind, so memory stays bounded, and
+    a late subscriber starts from the oldest item still in the buffer. Once
+    the last interested subscriber detaches the upstream generator is
+    cancelled; passive subscribers (like the persistence accumulator) don't
+    keep it alive on their own.
+    """
+
+    def __init__(
+        self, generator: AsyncGenerator, capacity: int = BROADCAST_CAPACITY
+    ):
+        self._generator = generator
+        self._capacity = capacity
+        self._buffer: List[Any] = [None] * capacity
+        self._head = 0
+        self._cursors: Dict[int, int] = {}
+        self._interested: Set[int] = set()
+        self._next_id = 0
+        self._readable = asyncio.Event()
+        self._readers_waiting = 0
+        self._writable = asyncio.Event()
+        self._writer_waiting = False
+        self._task: Optional[asyncio.Task] = None
+        self.done = False
+        self.cancelled = False
+        self.error: Optional[BaseException] = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._pump())
+
+    def subscribe(self, interested: bool = True) -> "Subscription":
+        id = self._next_id
+        self._next_id += 1
+        self._cursors[id] = max(0, self._head - self._capacity)
+        if interested:
+            self._interested.add(id)
+        return Subscription(self, id)
+
+    def _lag(self) -> int:
+        if not self._cursors:
+            return 0
+        return self._head - min(self._cursors.values())
+
+    # Events are only touched when someone is actually waiting on them, which
+    # keeps the per-item cost to a couple of integer comparisons.
+    def _wake_readers(self):
+        if self._readers_waiting:
+            self._readers_waiting = 0
+            self._readable.set()
+            self._readable = asyncio.Event()
+
+    def _wake_writer(self):
+        if self._writer_waiting:
+            self._writer_waiting = False
+            self._writable.set()
+
+    async def _wait_readable(self):
+        self._readers_waiting += 1
+        await self._readable.wait()
+
+    async def _wait_writable(self):
+        self._writable = asyncio.Event()
+        self._writer_waiting = True
+        await self._writable.wait()
+
+    def _detach(self, id: int):
+        if self._cursors.pop(id, None) is None:
+            return
+        self._interested.discard(id)
+        if not self._interested and not self.done and self._task is not None:
+            self._task.cancel()
+        self._wake_writer()
+
+    async def _pump(self):
+        try:
+            async for item in self._generator:
+                while self._lag() >= self._capacity:
+                    await self._wait_writable()
+                self._buffer[self._head % self._capacity] = item
+                self._head += 1
+                self._wake_readers()
+        except asyncio.CancelledError:
+            self.cancelled = True
+        except Exception as e:
+            self.error = e
+        finally:
+            self.done = True
+            self._wake_readers()
+            await self._generator.aclose()
+
+
+class Subscription:
+    def __init__(self, broadcast: Broadcast, id: int):
+        self._broadcast = broadcast
+        self._id = id
+        self._pending: List[Any] = []
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self._pending:
+            return self._pending.pop()
+        broadcast = self._broadcast
+        while True:
+            cursor = broadcast._cursors.get(self._id)
+            if cursor is None:
+                raise StopAsyncIteration
+            if cursor < broadcast._head:
+                # Take everything available at once, oldest item last.
+                end = broadcast._head
+                capacity = broadcast._capacity
+                self._pending = [
+                    broadcast._buffer[i % capacity]
+                    for i in range(end - 1, cursor, -1)
+                ]
+                item = broadcast._buffer[cursor % capacity]
+                broadcast._cursors[self._id] = end
+                broadcast._wake_writer()
+                return item
+            if broadcast.done:
+                self.close()
+                if broadcast.error is not None:
+                    raise broadcast.error
+                raise StopAsyncIteration
+            await broadcast._wait_readable()
+
+    def close(self):
+        self._broadcast._detach(self._id)
+
+    async def aclose(self):
+        self.close()
 
-    messages_concat = "".join(
-        map(
-            lambda m: str(m["content"]) if "content" in m else "",
-            messages_from_context(context),
-        )
-    )
-    enc = tiktoken.encoding_for_model("gpt-4o")
-    return len(enc.encode(messages_concat))
-
-
-def messages_from_context(
-    context: Dict[str, Any]
-) -> List[ChatCompletionMessageParamID]:
-    messages_json = context.get("messages", [])
-    messages: List[ChatCompletionMessageParamID] = []
-    for message in messages_json:
-        role = message.get("role")
-        content = message.get("content")
-        id = message.get("id")
-        if role == "user":
-            messages.append(
-                ChatCompletionUserMessageParamID(role="user", content=content, id=id)
-            )
-        elif role == "assistant":
-            messages.append(
-                ChatCompletionAssistantMessageParamID(
-                    role="assistant", content=content, id=id
-                )
-            )
-        else:
-            raise ValueError("unexpected message role")
-    return messages
-
-
-async def async_tee(
-    generator: AsyncGenerator, n: int = 2
-) -> Tuple[AsyncGenerator, ...]:
-    queues = [asyncio.Queue() for _ in range(n)]
-
-    async def distribute():
-        async for item in generator:
-            for queue in queues:
-                await queue.put(item)
-        for queue in queues:
-            await queue.put(None)
-
-    asyncio.create_task(distribute())
-    return tuple(_queue_to_async_gen(queue) for queue in queues)
-
-
-async def _queue_to_async_gen(queue: asyncio.Queue) -> AsyncGenerator:
-    while True:
-        item = await queue.get()
-        if item is None:
-            break
-        yield item
+    def __del__(self):
+        # Starlette drops the body iterator without closing it when the client
+        # disconnects, so detaching here is what cancels the upstream stream.
+        if not self._broadcast.done:
+            self.close()
@@ -1,36 +1,114 @@
-import os
 import asyncio
-from re import M
-from typing import Optional
-from uuid import uuid4
+import hashlib
+import logging
+import time
+from contextlib import asynccontextmanager
+from typing import Awaitable, Callable, List, Optional
+from uuid import UUID, uuid4
 
-from fastapi import FastAPI, Depends, HTTPException
-from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
+from fastapi import FastAPI, Depends, Header, HTTPException, Query, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse
-import jwt
-from jwt import PyJWKClient
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import JSONResponse, ORJSONResponse, StreamingResponse
+from fastapi.security import HTTPAuthorizationCredentials
 from dotenv import load_dotenv
-from sqlalchemy.orm import Session
+from prometheus_client import CONTENT_TYPE_LATEST
+from sqlalchemy.exc import NoResultFound
+from sqlalchemy.ext.asyncio import AsyncSession
 
-from app.ai import generate_chat
+from app.admission import (
+    Rejected,
+    abandon,
+    bot_turns,
+    hold,
+    rate_limiter,
+    upstream_slots,
+)
+from app.ai import generate_chat, get_backend
+from app.auth import (
+    jwks_client,
+    optional_verify_token,
+    security,
+    unverified_subject,
+)
+from app.context import assemble_context, summarizer
+from app.cache import Lookup
 from app.crud import (
-    get_bot,
-    get_or_create_bot,
-    get_or_create_user,
-    get_user,
-    persist_next_message,
+    archive_bot,
+    delete_bot,
+    get_message_page,
+    get_messages,
+    lookup,
+)
+from app.lib import (
+    COALESCE_BYTES,
+    Broadcast,
+    coalesce,
+    count_tokens,
+    get_encoding,
 )
-from app.lib import async_tee, messages_from_context, tokens_for_context
 import app.models as models
 import app.schemas as schemas
 from app.database import SessionLocal
-from app.types import ChatCompletionUserMessageParamID
+from app.metrics import (
+    APP_STARTUP_SECONDS,
+    CHAT_REJECTED,
+    latest,
+    loop_lag_monitor,
+    observe_stream,
+    scrape_allowed,
+)
+from app.offload import run_in_pool, worth_offloading
+from app.persistence import persistence_worker
+from app.reads import READ_PIN_COOKIE, ReadPin, ReadSession, set_read_pin
+from app.streams import SSE_HEADERS, replay_buffer
+from app.sweeper import MAX_TOKENS, bot_sweeper
+from app.types import ChatMessage
 
 load_dotenv()
 
-app = FastAPI()
-security = HTTPBearer()
+logger = logging.getLogger(__name__)
+
+
+async def startup_step(phase: str, step: Callable[[], Awaitable]):
+    start = time.perf_counter()
+    try:
+        await step()
+    except Exception:
+        logger.exception("startup: %s failed, will retry on first use", phase)
+    elapsed = time.perf_counter() - start
+    APP_STARTUP_SECONDS.labels(phase=phase).set(elapsed)
+    logger.info("startup: %s took %.0f ms", phase, elapsed * 1000)
+
+
+async def start_llm():
+    await startup_step("llm_client", lambda: asyncio.to_thread(get_backend))
+    # Open upstream connections now rather than on the first turns.
+    await startup_step("llm_pool", lambda: get_backend().warm())
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    persistence_worker.start()
+    bot_sweeper.start()
+    loop_lag_monitor.start()
+    # The tokenizer and LLM client are loaded lazily so scripts importing the
+    # app stay quick; the server loads them before taking traffic instead of
+    # on the first request.
+    await asyncio.gather(
+        startup_step("jwks", jwks_client.refresh),
+        startup_step("tokenizer", lambda: asyncio.to_thread(get_encoding)),
+        start_llm(),
+    )
+    yield
+    loop_lag_monitor.stop()
+    bot_sweeper.stop()
+    # Drain completed turns so replies aren't lost on restart.
+    await persistence_worker.stop()
+    await jwks_client.aclose()
+
+
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
 
 # Configure CORS
 app.add_middleware(
@@ -44,96 +122,105 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["ETag"],
 )
 
-ENV = os.getenv("ENV")
-DEV_USER_ID = "user_2jfLb9a9wPGdc4vSPE1G3h8OVVI"
-CLERK_JWT_ISSUER = os.getenv("CLERK_JWT_ISSUER")
-CLERK_JWKS_URL = f"{CLERK_JWT_ISSUER}/.well-known/jwks.json"
-MAX_TOKENS = 4096  # TODO: make sure this aligns with the frontend
 
-if CLERK_JWT_ISSUER is None or CLERK_JWT_ISSUER == "":
-    raise ValueError("Missing CLERK_JWT_ISSUER")
+class NonStreamingGZipMiddleware(GZipMiddleware):
+    # Gzip holds back output until it has a block's worth, which would stall
+    # SSE events, so streaming endpoints are passed through untouched.
+    streaming_paths = {"/chat"}
 
-# Initialize the PyJWKClient
-jwks_client = PyJWKClient(CLERK_JWKS_URL)
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["path"] in self.streaming_paths:
+            await self.app(scope, receive, send)
+            return
+        await super().__call__(scope, receive, send)
 
 
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
+app.add_middleware(NonStreamingGZipMiddleware, minimum_size=1024)
 
+HISTORY_PAGE_SIZE = 50
+# Browsers may keep these, but must check the ETag before reusing them.
+CACHE_HEADERS = {"Cache-Control": "private, no-cache"}
 
-def get_signing_key(token):
-    try:
-        signing_key = jwks_client.get_signing_key_from_jwt(token)
-        return signing_key.key
-    except jwt.exceptions.PyJWKClientError as error:
-        raise HTTPException(status_code=401, detail=str(error))
 
+def make_etag(*parts) -> str:
+    digest = hashlib.sha1(":".join(map(str, parts)).encode()).hexdigest()
+    return f'W/"{digest[:20]}"'
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    # Compared weakly: W/"x" and "x" are the same version.
+    candidates = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+    return etag.removeprefix("W/") in candidates
 
-async def optional_verify_token(
-    credentials: HTTPAuthorizationCredentials = Depends(security),
-) -> Optional[dict]:
-    try:
-        return await verify_token(credentials)
-    except HTTPException as e:
-        if ENV == "dev":
-            return {
-                "sub": DEV_USER_ID,
-            }
-        raise e
 
+def not_modified(etag: str) -> Response:
+    return Response(status_code=304, headers={"ETag": etag, **CACHE_HEADERS})
 
-async def verify_token(credentials: HTTPAuthorizationCredentials = Depends(security)):
-    token = credentials.credentials
+
+def render_page(page: List[models.Message], cursor: Optional[str]) -> str:
+    # Decompressing and serializing a long page is the slow part of the
+    # endpoint, so bot_messages runs this in the CPU pool.
+    return schemas.MessagePage.model_validate(
+        {"messages": page, "next": cursor}, from_attributes=True
+    ).model_dump_json()
+
+
+@app.exception_handler(Rejected)
+async def rejected_handler(request: Request, exc: Rejected):
+    CHAT_REJECTED.labels(reason=exc.reason).inc()
+    return JSONResponse(
+        status_code=429,
+        content={"detail": f"Too many requests ({exc.reason})"},
+        headers=exc.headers,
+    )
+
+
+async def get_db():
+    async with SessionLocal() as db:
+        yield db
+
+
+async def get_reader(request: Request):
+    # For handlers that only read: the replica, unless the client's read pin
+    # says it may not have their last write yet.
+    reader = ReadSession(ReadPin.decode(request.cookies.get(READ_PIN_COOKIE)))
     try:
-        signing_key = get_signing_key(token)
-        payload = jwt.decode(
-            token,
-            signing_key,
-            algorithms=["RS256"],
-            issuer=CLERK_JWT_ISSUER,
-            options={
-                "verify_signature": True,
-                "verify_exp": True,
-                "verify_aud": True,
-                "verify_iss": True,
-            },
-        )
-        return payload
-    except jwt.ExpiredSignatureError:
-        raise HTTPException(status_code=401, detail="Token has expired")
-    except jwt.InvalidAudienceError:
-        raise HTTPException(status_code=401, detail="Invalid audience")
-    except jwt.InvalidIssuerError:
-        raise HTTPException(status_code=401, detail="Invalid issuer")
-    except jwt.InvalidTokenError as e:
-        raise HTTPException(status_code=401, detail=f"Invalid token: {str(e)}")
+        yield reader
+    finally:
+        await reader.close()
 
 
 @app.get("/me", response_model=schemas.User)
 async def user(
-    token_data: dict = Depends(optional_verify_token), db: Session = Depends(get_db)
+    token_data: dict = Depends(optional_verify_token),
+    reader: ReadSession = Depends(get_reader),
 ):
     clerk_id = token_data["sub"]
-    user = get_or_create_user(db=db, clerk_id=clerk_id)
-    return user
+    found = await reader.lookup(clerk_id, create_user=True)
+    return found.user
 
 
 @app.delete("/bot")
-async def delete_bot(
-    token_data: dict = Depends(optional_verify_token), db: Session = Depends(get_db)
+async def remove_bot(
+    response: Response,
+    token_data: dict = Depends(optional_verify_token),
+    db: AsyncSession = Depends(get_db),
 ):
     clerk_id = token_data["sub"]
-    user = get_user(db=db, clerk_id=clerk_id)
-    bot = get_bot(db=db, user_id=user.id)
-    if bot:
-        db.delete(bot)
-        db.commit()
+    try:
+        found = await lookup(db=db, clerk_id=clerk_id)
+    except NoResultFound:
+        raise HTTPException(status_code=404, detail="User not found")
+    if found.bot:
+        await delete_bot(db=db, bot_id=found.bot.id)
+        set_read_pin(response, ReadPin.after_write())
         return {"detail": "Bot deleted successfully"}
     else:
         raise HTTPException(status_code=404, detail="Bot not found")
@@ -141,56 +228,207 @@ async def delete_bot(
 
 @app.get("/bot", response_model=schemas.Bot)
 async def bot(
-    token_data: dict = Depends(optional_verify_token), db: Session = Depends(get_db)
+    response: Response,
+    token_data: dict = Depends(optional_verify_token),
+    reader: ReadSession = Depends(get_reader),
+    if_none_match: Optional[str] = Header(None),
 ):
     clerk_id = token_data["sub"]
-    user = get_or_create_user(db=db, clerk_id=clerk_id)
-    bot = get_or_create_bot(db=db, user_id=user.id)
-    if tokens_for_context(bot.context) >= MAX_TOKENS:
-        name = bot.name
-        db.delete(bot)
-        db.commit()
-        raise HTTPException(
-            status_code=404, detail=f"Sorry, {name} is no longer with us."
+    found = await reader.lookup(clerk_id, create_user=True, create_bot=True)
+    bot = found.bot
+    if bot.tokens >= MAX_TOKENS:
+        # Archived once the user has seen this, so their next /bot starts a
+        # new bot; the sweeper deletes the old one.
+        async with SessionLocal() as primary:
+            await archive_bot(db=primary, bot_id=bot.id)
+        bot_sweeper.wake()
+        farewell = JSONResponse(
+            status_code=404,
+            content={"detail": f"Sorry, {bot.name} is no longer with us."},
         )
-    return bot
+        set_read_pin(farewell, ReadPin.after_write())
+        return farewell
+    etag = make_etag(bot.id, bot.tokens, bot.message_count)
+    if etag_matches(if_none_match, etag):
+        return not_modified(etag)
+    response.headers.update({"ETag": etag, **CACHE_HEADERS})
+    return {
+        "id": bot.id,
+        "name": bot.name,
+        "creator_id": bot.creator_id,
+        "tokens": bot.tokens,
+        "message_count": bot.message_count,
+    }
+
+
+@app.get("/bot/messages", response_model=schemas.MessagePage)
+async def bot_messages(
+    response: Response,
+    # Message ids are UUIDs; anything else is a 422 rather than a query
+    # Postgres would reject.
+    before: Optional[UUID] = None,
+    limit: int = Query(HISTORY_PAGE_SIZE, ge=1, le=200),
+    token_data: dict = Depends(optional_verify_token),
+    reader: ReadSession = Depends(get_reader),
+    if_none_match: Optional[str] = Header(None),
+):
+    """The bot's history, newest first.
+
+    Pass the ``next`` of one page as ``before`` to fetch the one after it.
+    """
+    clerk_id = token_data["sub"]
+    try:
+        bot = (await reader.lookup(clerk_id, require_bot=True)).bot
+    except NoResultFound:
+        raise HTTPException(status_code=404, detail="User not found")
+    if bot is None:
+        raise HTTPException(status_code=404, detail="Bot not found")
+
+    rows = await get_message_page(
+        db=reader.db,
+        bot_id=bot.id,
+        before=str(before) if before is not None else None,
+        limit=limit + 1,
+    )
+    page = rows[:limit]
+    cursor = page[-1].id if len(rows) > limit else None
+
+    # Messages are append-only, so a page's newest message pins it down. The
+    # tag comes from the rows served, wherever the lookup's answer came from.
+    etag = make_etag(bot.id, page[0].id if page else None, before, limit)
+    if etag_matches(if_none_match, etag):
+        return not_modified(etag)
+    response.headers.update({"ETag": etag, **CACHE_HEADERS})
+    if worth_offloading(sum(row.tokens for row in page)):
+        body = await run_in_pool(render_page, page, cursor)
+        headers = {"ETag": etag, **CACHE_HEADERS}
+        return Response(body, media_type="application/json", headers=headers)
+    return {"messages": page, "next": cursor}
+
+
+async def prefetch_lookup(clerk_id: Optional[str]) -> Optional[Lookup]:
+    # Runs before the token is verified, so it only reads: nothing is created
+    # for a subject that may turn out to be forged.
+    if clerk_id is None:
+        return None
+    try:
+        async with SessionLocal() as db:
+            return await lookup(db=db, clerk_id=clerk_id)
+    except NoResultFound:
+        return None
 
 
 @app.get("/chat", response_class=StreamingResponse)
 async def stream_chat(
     message: str,
-    token_data: dict = Depends(optional_verify_token),
-    db: Session = Depends(get_db),
+    credentials: HTTPAuthorizationCredentials = Depends(security),
+    last_event_id: Optional[str] = Header(None),
 ):
+    started = time.perf_counter()
+    # Look the user up while their token is verified (which can mean fetching
+    # the issuer's keys); the result is only used if the subjects match.
+    subject = None if last_event_id else unverified_subject(credentials.credentials)
+    prefetch = asyncio.create_task(prefetch_lookup(subject))
+    try:
+        token_data = await optional_verify_token(credentials)
+    except BaseException:
+        prefetch.cancel()
+        raise
+    found = await prefetch
     clerk_id = token_data["sub"]
-    user = db.query(models.User).filter_by(clerk_id=clerk_id).first()
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
-    bot = get_or_create_bot(db=db, user_id=user.id)
-    messages = []
-    response_message_id = str(uuid4())
-    if bot.context is not None:
-        messages = messages_from_context(context=bot.context)
-    messages.append(
-        ChatCompletionUserMessageParamID(
-            role="user",
-            content=message,
-            id=str(uuid4()),
+    if last_event_id:
+        # A reconnecting client resumes the reply it was already receiving
+        # rather than starting a new turn. 204 tells EventSource to stop.
+        resumed = replay_buffer.resume(last_event_id, owner=clerk_id)
+        if resumed is None:
+            return Response(status_code=204)
+        return StreamingResponse(
+            resumed, media_type="text/event-stream", headers=SSE_HEADERS
         )
-    )
 
-    # Tee off the generating message to respond to the user and persist in parallel.
-    accumulator, responder = await async_tee(generate_chat(messages))
+    await rate_limiter.acquire(clerk_id)
+    # The reply can stream for tens of seconds, so rather than a request-long
+    # get_db session, each step below holds a connection only while it runs.
+    # The persistence worker writes the finished turn with a session of its own.
+    if subject != clerk_id or found is None or found.bot is None:
+        async with SessionLocal() as db:
+            try:
+                found = await lookup(db=db, clerk_id=clerk_id, create_bot=True)
+            except NoResultFound:
+                raise HTTPException(status_code=404, detail="User not found")
+    bot = found.bot
+
+    # One turn per bot at a time; the slot is held until the turn has been
+    # written, so the next turn reads complete history.
+    bot_lease = await bot_turns.acquire(bot.id)
+    upstream_lease = None
+    # Wait for an upstream slot while the history loads and the new message
+    # is tokenized.
+    acquiring = asyncio.create_task(upstream_slots.acquire())
+    try:
+        async with SessionLocal() as db:
+            messages, tokens = await asyncio.gather(
+                get_messages(db=db, bot_id=bot.id),
+                count_tokens(message),
+            )
+        upstream_lease = await acquiring
+        response_message_id = str(uuid4())
+        user_message = ChatMessage(
+            role="user", content=message, id=str(uuid4()), tokens=tokens
+        )
+        seq = len(messages)
+        messages.append(user_message)
+
+        # Only the persona, a summary of older turns and the most recent turns
+        # that fit the token budget are sent upstream.
+        summary = bot.context.get("summary")
+        window = assemble_context(messages, summary)
+        summarizer.schedule(bot.id, summary, window)
+
+        stream = generate_chat(window.messages)
+        if COALESCE_BYTES > 0:
+            stream = coalesce(stream)
+        stream = observe_stream(stream, started)
+        stream = hold(stream, upstream_lease)
 
-    # Start the accumulator consumer in the background
-    asyncio.create_task(
-        persist_next_message(
-            db=db,
-            bot=bot,
+        # Broadcast the generating message to respond to the user and persist in
+        # parallel. Only the replay recording keeps the upstream stream alive.
+        broadcast = Broadcast(stream)
+        accumulator = broadcast.subscribe(interested=False)
+        replay = replay_buffer.record(
+            response_message_id, owner=clerk_id, subscription=broadcast.subscribe()
+        )
+        broadcast.start()
+
+        # The persistence worker appends the user's message right away, while
+        # the upstream request is opened, and the reply once the stream ends.
+        persistence_worker.persist_stream(
+            bot_id=bot.id,
             accumulator=accumulator,
-            messages=messages,
+            user_message=user_message,
             message_id=response_message_id,
+            seq=seq,
+            on_written=bot_lease.release,
         )
+    except BaseException:
+        if upstream_lease is not None:
+            upstream_lease.release()
+        else:
+            abandon(acquiring)
+        bot_lease.release()
+        raise
+
+    response = StreamingResponse(
+        replay.events(), media_type="text/event-stream", headers=SSE_HEADERS
     )
+    # The user's reads of this bot stay on the primary until the replica has
+    # both of the turn's messages.
+    set_read_pin(response, ReadPin.after_write(bot.id, messages=seq + 2))
+    return response
+
 
-    return StreamingResponse(responder, media_type="text/event-stream")
+@app.get("/metrics", include_in_schema=False)
+async def metrics(authorization: Optional[str] = Header(None)):
+    if not scrape_allowed(authorization):
+        raise HTTPException(status_code=404)
+    return Response(latest(), media_type=CONTENT_TYPE_LATEST)
@@ -0,0 +1,252 @@
+import asyncio
+import functools
+import hmac
+import os
+import time
+from typing import AsyncGenerator, AsyncIterator, Optional
+
+from prometheus_client import (
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+
+# /metrics is on the public API origin, so it is only served with
+# "Authorization: Bearer $METRICS_TOKEN", or to anyone in dev when no token is
+# set. Client addresses aren't a safe check: behind the proxy they are all
+# private.
+METRICS_TOKEN = os.getenv("METRICS_TOKEN") or None
+ENV = os.getenv("ENV")
+
+# Streams are judged in seconds, queries and token counting in milliseconds.
+STREAM_BUCKETS = (0.1, 0.25, 0.5, 1, 2, 4, 8, 15, 30, 60, 120)
+FAST_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1)
+# Waits for a pooled connection can run up to DB_POOL_TIMEOUT.
+POOL_BUCKETS = FAST_BUCKETS + (2.5, 5, 10, 30)
+# A reply is one delta per token upstream, up to a few thousand.
+CHUNK_BUCKETS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+CHAT_TIME_TO_FIRST_TOKEN = Histogram(
+    "chat_time_to_first_token_seconds",
+    "Time from a /chat request arriving to its first reply chunk.",
+    buckets=STREAM_BUCKETS,
+)
+CHAT_STREAM_DURATION = Histogram(
+    "chat_stream_duration_seconds",
+    "Time from a /chat request arriving to the end of its reply.",
+    ["outcome"],
+    buckets=STREAM_BUCKETS,
+)
+CHAT_STREAM_DELTAS = Histogram(
+    "chat_stream_deltas",
+    "Deltas received from upstream per /chat reply, counted while coalescing.",
+    buckets=CHUNK_BUCKETS,
+)
+CHAT_STREAM_WRITES = Histogram(
+    "chat_stream_writes",
+    "Chunks written to the client per /chat reply.",
+    buckets=CHUNK_BUCKETS,
+)
+CHAT_REJECTED = Counter(
+    "chat_rejected", "/chat requests turned away with a 429.", ["reason"]
+)
+CHAT_OPEN_STREAMS = Gauge(
+    "chat_open_streams",
+    "SSE responses currently being sent to clients.",
+    multiprocess_mode="livesum",
+)
+
+LLM_PROMPT_TOKENS = Counter(
+    "llm_prompt_tokens", "Prompt tokens reported by the upstream.", ["model"]
+)
+LLM_COMPLETION_TOKENS = Counter(
+    "llm_completion_tokens", "Completion tokens reported by the upstream.", ["model"]
+)
+LLM_HEDGED_REQUESTS = Counter(
+    "llm_hedged_requests",
+    "Streams slow to their first token that raced a duplicate request.",
+    ["winner"],
+)
+LLM_FIRST_TOKEN_TIMEOUTS = Counter(
+    "llm_first_token_timeouts", "Streams given up on before their first token."
+)
+
+DB_QUERY_DURATION = Histogram(
+    "db_query_duration_seconds",
+    "Time spent in app.crud calls.",
+    ["operation"],
+    buckets=FAST_BUCKETS,
+)
+DB_POOL_CHECKOUT_DURATION = Histogram(
+    "db_pool_checkout_seconds",
+    "Time spent getting a connection from the pool, including any wait.",
+    buckets=POOL_BUCKETS,
+)
+DB_POOL_CHECKED_OUT = Gauge(
+    "db_pool_checked_out",
+    "Pooled database connections currently in use.",
+    multiprocess_mode="livesum",
+)
+DB_POOL_TIMEOUTS = Counter(
+    "db_pool_timeouts", "Checkouts that gave up waiting for a connection."
+)
+DB_READ_SESSIONS = Counter(
+    "db_read_sessions",
+    "Sessions opened for read-only requests, by the database they used.",
+    ["database"],
+)
+TOKENIZE_DURATION = Histogram(
+    "tokenize_duration_seconds",
+    "Time spent counting tokens.",
+    ["function"],
+    buckets=FAST_BUCKETS,
+)
+JWT_VERIFY_DURATION = Histogram(
+    "jwt_verify_duration_seconds",
+    "Time spent verifying bearer tokens.",
+    ["cache"],
+    buckets=FAST_BUCKETS,
+)
+
+EXPIRED_BOTS_DELETED = Counter(
+    "expired_bots_deleted",
+    "Expired bots the sweeper removed after their farewell or grace period.",
+)
+
+LOOKUP_CACHE_REQUESTS = Counter(
+    "lookup_cache_requests", "User and bot lookups by cache result.", ["result"]
+)
+
+BACKGROUND_TASKS = Gauge(
+    "background_tasks",
+    "Background tasks currently in flight.",
+    ["kind"],
+    multiprocess_mode="livesum",
+)
+PERSISTENCE_QUEUE_DEPTH = Gauge(
+    "persistence_queue_depth",
+    "Completed turns waiting to be written.",
+    multiprocess_mode="livesum",
+)
+
+LOOP_LAG_INTERVAL = float(os.getenv("LOOP_LAG_INTERVAL", "0.25"))
+EVENT_LOOP_LAG = Histogram(
+    "event_loop_lag_seconds",
+    "How late the event loop woke up for a timer, sampled every "
+    "LOOP_LAG_INTERVAL seconds.",
+    buckets=FAST_BUCKETS,
+)
+
+APP_STARTUP_SECONDS = Gauge(
+    "app_startup_seconds",
+    "Time each startup step took.",
+    ["phase"],
+    multiprocess_mode="max",
+)
+
+
+def scrape_allowed(authorization: Optional[str]) -> bool:
+    if METRICS_TOKEN is None:
+        return ENV == "dev"
+    return hmac.compare_digest(
+        (authorization or "").encode(), f"Bearer {METRICS_TOKEN}".encode()
+    )
+
+
+def latest() -> bytes:
+    # Under gunicorn each worker writes its samples to PROMETHEUS_MULTIPROC_DIR
+    # so that a scrape, whichever worker answers it, reports all of them.
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry)
+    return generate_latest()
+
+
+class LoopLagMonitor:
+    """Samples how long the event loop takes to get back to a due timer.
+
+    Anything running on the loop without yielding (tokenizing, serializing,
+    decompressing) delays every stream in the process by as much.
+    """
+
+    def __init__(self, interval: float = LOOP_LAG_INTERVAL):
+        self.interval = interval
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            EVENT_LOOP_LAG.observe(max(0.0, loop.time() - start - self.interval))
+
+
+loop_lag_monitor = LoopLagMonitor()
+
+
+def track_task(task: asyncio.Task, kind: str):
+    gauge = BACKGROUND_TASKS.labels(kind=kind)
+    gauge.inc()
+    task.add_done_callback(lambda _: gauge.dec())
+
+
+def timed_query(fn):
+    histogram = DB_QUERY_DURATION.labels(operation=fn.__name__)
+
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await fn(*args, **kwargs)
+        finally:
+            histogram.observe(time.perf_counter() - start)
+
+    return wrapper
+
+
+def timed_tokenize(fn):
+    return TOKENIZE_DURATION.labels(function=fn.__name__).time()(fn)
+
+
+async def observe_stream(
+    stream: AsyncIterator[str], started: float
+) -> AsyncGenerator[str, None]:
+    """Pass ``stream`` through, recording time to first token, duration and
+    the number of chunks written.
+
+    ``started`` is a time.perf_counter() reading from when the request came
+    in, so both include the setup work ahead of the upstream call.
+    """
+    outcome = "cancelled"
+    writes = 0
+    try:
+        async for chunk in stream:
+            if writes == 0:
+                CHAT_TIME_TO_FIRST_TOKEN.observe(time.perf_counter() - started)
+            writes += 1
+            yield chunk
+        outcome = "ok"
+    except Exception:
+        outcome = "error"
+        raise
+    finally:
+        CHAT_STREAM_DURATION.labels(outcome=outcome).observe(
+            time.perf_counter() - started
+        )
+        CHAT_STREAM_WRITES.observe(writes)
+        aclose = getattr(stream, "aclose", None)
+        if aclose is not None:
+            await aclose()
@@ -1,8 +1,20 @@
-from typing import Any, Dict
+from typing import Any, Dict, Optional
 import uuid
-from sqlalchemy import JSON, UUID, Boolean, Column, ForeignKey, Integer, String
+from sqlalchemy import (
+    JSON,
+    UUID,
+    Boolean,
+    Column,
+    DateTime,
+    ForeignKey,
+    Integer,
+    LargeBinary,
+    String,
+    Text,
+)
 from sqlalchemy.orm import Mapped, mapped_column, relationship
 
+from app import compression
 from app.database import Base
 
 
@@ -22,6 +34,66 @@ class Bot(Base):
     id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
     name = Column(String, index=True)
     context: Mapped[Dict[str, Any]] = mapped_column(JSON)
+    tokens = Column(
+        Integer, nullable=False, default=0, server_default="0", index=True
+    )
     creator_id = Column(UUID, ForeignKey("users.id"))
+    # Set by the sweeper once tokens reach MAX_TOKENS.
+    expired_at = Column(DateTime(timezone=True), nullable=True, index=True)
+    # Set once /bot has told the user the bot is gone; from then on the bot is
+    # archived: lookups no longer find it and the sweeper deletes it.
+    farewell_at = Column(DateTime(timezone=True), nullable=True, index=True)
 
     creator = relationship("User", back_populates="bots")
+    messages = relationship(
+        "Message",
+        back_populates="bot",
+        order_by="Message.seq",
+        cascade="all, delete-orphan",
+        passive_deletes=True,
+    )
+
+
+class Message(Base):
+    __tablename__ = "messages"
+
+    bot_id = Column(
+        UUID(as_uuid=True),
+        ForeignKey("bots.id", ondelete="CASCADE"),
+        primary_key=True,
+    )
+    seq = Column(Integer, primary_key=True)
+    id = Column(
+        UUID(as_uuid=False),
+        unique=True,
+        nullable=False,
+        default=lambda: str(uuid.uuid4()),
+    )
+    role = Column(String, nullable=False)
+    # A row has either plain or compressed content, see app.compression.
+    _content = Column("content", Text)
+    content_z = Column(LargeBinary)
+    tokens = Column(Integer, nullable=False, default=0, server_default="0")
+
+    bot = relationship("Bot", back_populates="messages")
+
+    @property
+    def content(self) -> Optional[str]:
+        if self.content_z is None:
+            return self._content
+        # Inflated on first access only; most loads just need the tokens.
+        decoded = self.__dict__.get("_decoded_content")
+        if decoded is None:
+            decoded = compression.decompress_text(self.content_z)
+            self.__dict__["_decoded_content"] = decoded
+        return decoded
+
+    @content.setter
+    def content(self, value: Optional[str]):
+        self.__dict__.pop("_decoded_content", None)
+        if compression.should_compress(value):
+            self._content = None
+            self.content_z = compression.compress_text(value)
+        else:
+            self._content = value
+            self.content_z = None
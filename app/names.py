@@ -0,0 +1,38 @@
+import random
+
+# The most common US first names (Faker's en_US list, top 100 each by
+# frequency). A fixed tuple, so naming a bot is one random.choice instead of
+# building a Faker instance per call.
+# fmt: off
+BOT_NAMES = (
+    "Aaron", "Adam", "Alan", "Alex", "Alexander", "Alexis", "Alicia", "Allison",
+    "Alyssa", "Amanda", "Amber", "Amy", "Andrea", "Andrew", "Angela", "Anna", "Anthony",
+    "Antonio", "April", "Ashley", "Austin", "Barbara", "Benjamin", "Bradley", "Brandon",
+    "Brenda", "Brett", "Brian", "Brittany", "Bryan", "Carlos", "Catherine", "Chad",
+    "Charles", "Cheryl", "Christian", "Christina", "Christine", "Christopher", "Cindy",
+    "Cody", "Corey", "Courtney", "Craig", "Crystal", "Curtis", "Cynthia", "Dana",
+    "Daniel", "Danielle", "David", "Dawn", "Deborah", "Debra", "Denise", "Dennis",
+    "Derek", "Diana", "Diane", "Donald", "Donna", "Douglas", "Dustin", "Dylan",
+    "Edward", "Elizabeth", "Emily", "Eric", "Erica", "Erin", "Frank", "Gary", "George",
+    "Gregory", "Hannah", "Heather", "Holly", "Jacob", "Jacqueline", "James", "Jamie",
+    "Jared", "Jason", "Jeffery", "Jeffrey", "Jennifer", "Jeremy", "Jerry", "Jesse",
+    "Jessica", "Jill", "Joel", "John", "Johnny", "Jonathan", "Jordan", "Jose", "Joseph",
+    "Joshua", "Juan", "Julia", "Julie", "Justin", "Karen", "Katherine", "Kathleen",
+    "Kathryn", "Katie", "Kayla", "Keith", "Kelly", "Kenneth", "Kevin", "Kimberly",
+    "Kristen", "Kristin", "Kyle", "Larry", "Laura", "Lauren", "Leslie", "Linda", "Lisa",
+    "Lori", "Luis", "Marcus", "Margaret", "Maria", "Mark", "Mary", "Matthew", "Megan",
+    "Melanie", "Melissa", "Michael", "Michele", "Michelle", "Monica", "Nancy",
+    "Natalie", "Nathan", "Nicholas", "Nicole", "Pamela", "Patricia", "Patrick", "Paul",
+    "Peter", "Philip", "Phillip", "Rachel", "Randy", "Raymond", "Rebecca", "Richard",
+    "Robert", "Robin", "Rodney", "Ronald", "Ryan", "Samantha", "Samuel", "Sandra",
+    "Sara", "Sarah", "Scott", "Sean", "Shane", "Shannon", "Sharon", "Shawn", "Stacy",
+    "Stephanie", "Stephen", "Steven", "Susan", "Tammy", "Tara", "Taylor", "Teresa",
+    "Terry", "Theresa", "Thomas", "Tiffany", "Timothy", "Tina", "Todd", "Tony", "Tracy",
+    "Travis", "Troy", "Tyler", "Valerie", "Vanessa", "Victor", "Victoria", "Vincent",
+    "Wendy", "William", "Zachary",
+)
+# fmt: on
+
+
+def bot_name() -> str:
+    return random.choice(BOT_NAMES)
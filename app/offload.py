@@ -0,0 +1,35 @@
+import asyncio
+import functools
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional, TypeVar
+
+# Tokenizing or serializing a large payload on the event loop stalls every
+# stream in the process until it's done, so anything at least this big (in
+# tokens, or about four characters each) runs in a small thread pool instead.
+# tiktoken releases the GIL while it encodes; pure-Python work still holds it,
+# but the loop gets to run between the interpreter's switch intervals.
+OFFLOAD_MIN_TOKENS = int(os.getenv("OFFLOAD_MIN_TOKENS", "1000"))
+CPU_POOL_SIZE = int(os.getenv("CPU_POOL_SIZE", str(min(os.cpu_count() or 1, 4))))
+
+T = TypeVar("T")
+
+_pool: Optional[ThreadPoolExecutor] = None
+
+
+def get_pool() -> ThreadPoolExecutor:
+    # Created on first use, so a gunicorn master that preloads the app doesn't
+    # fork workers holding a pool whose threads didn't survive the fork.
+    global _pool
+    if _pool is None:
+        _pool = ThreadPoolExecutor(CPU_POOL_SIZE, thread_name_prefix="cpu")
+    return _pool
+
+
+def worth_offloading(tokens: int) -> bool:
+    return tokens >= OFFLOAD_MIN_TOKENS
+
+
+async def run_in_pool(fn: Callable[..., T], *args) -> T:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_pool(), functools.partial(fn, *args))
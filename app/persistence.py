@@ -0,0 +1,206 @@
+import asyncio
+import logging
+import os
+from typing import AsyncIterator, Callable, List, Optional, Set
+from uuid import UUID
+
+from sqlalchemy.exc import IntegrityError
+
+from app.crud import next_seq, persist_turns
+from app.database import SessionLocal
+from app.lib import count_tokens
+from app.metrics import PERSISTENCE_QUEUE_DEPTH, track_task
+from app.types import ChatMessage, Turn
+
+PERSIST_QUEUE_SIZE = int(os.getenv("PERSIST_QUEUE_SIZE", "256"))
+PERSIST_BATCH_SIZE = int(os.getenv("PERSIST_BATCH_SIZE", "64"))
+PERSIST_SHUTDOWN_TIMEOUT = float(os.getenv("PERSIST_SHUTDOWN_TIMEOUT", "30"))
+
+logger = logging.getLogger(__name__)
+
+
+class PersistenceWorker:
+    """Write-behind persistence for chat turns.
+
+    A turn's user message is queued as soon as its stream starts and the reply
+    once the stream finishes; a single worker task writes them in batched
+    transactions. The queue is bounded, so producers wait when the database
+    falls behind instead of piling up tasks.
+    """
+
+    def __init__(
+        self,
+        maxsize: int = PERSIST_QUEUE_SIZE,
+        batch_size: int = PERSIST_BATCH_SIZE,
+    ):
+        self.batch_size = batch_size
+        self.queue: asyncio.Queue[Turn] = asyncio.Queue(maxsize=maxsize)
+        self.pending: Set[asyncio.Task] = set()
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self, timeout: float = PERSIST_SHUTDOWN_TIMEOUT):
+        # Let in-flight streams finish accumulating, then flush the queue.
+        if self.pending:
+            await asyncio.wait(self.pending, timeout=timeout)
+        if self._task is not None:
+            try:
+                await asyncio.wait_for(self.queue.join(), timeout=timeout)
+            except asyncio.TimeoutError:
+                logger.error("dropping %d unpersisted turns", self.queue.qsize())
+            self._task.cancel()
+            self._task = None
+
+    async def submit(self, turn: Turn):
+        if self.queue.full():
+            logger.warning("persistence queue is full, waiting for the worker")
+        await self.queue.put(turn)
+        PERSISTENCE_QUEUE_DEPTH.set(self.queue.qsize())
+
+    def persist_stream(
+        self,
+        bot_id: UUID,
+        accumulator: AsyncIterator[str],
+        user_message: ChatMessage,
+        message_id: str,
+        seq: int,
+        on_written: Optional[Callable[[], None]] = None,
+    ):
+        task = asyncio.create_task(
+            self._accumulate(
+                bot_id, accumulator, user_message, message_id, seq, on_written
+            )
+        )
+        self.pending.add(task)
+        task.add_done_callback(self.pending.discard)
+        track_task(task, "persist")
+
+    async def _accumulate(
+        self,
+        bot_id: UUID,
+        accumulator: AsyncIterator[str],
+        user_message: ChatMessage,
+        message_id: str,
+        seq: int,
+        on_written: Optional[Callable[[], None]],
+    ):
+        queued = submitted = False
+        # The user's message is written ahead of the reply, so it is kept even
+        # if the upstream call fails or the process dies mid-stream.
+        user_written: asyncio.Future[bool] = asyncio.get_running_loop().create_future()
+        user_turn = Turn(
+            bot_id=bot_id,
+            seq=seq,
+            messages=[user_message],
+            on_written=user_written.set_result,
+        )
+
+        def release(written: bool):
+            if on_written is not None:
+                on_written()
+
+        try:
+            await self.submit(user_turn)
+            queued = True
+            latest_message = ""
+            try:
+                async for item in accumulator:
+                    latest_message += item
+            except Exception as e:
+                logger.warning("no reply to persist for bot %s: %r", bot_id, e)
+                return
+            assistant_message = ChatMessage(
+                role="assistant",
+                content=latest_message,
+                id=message_id,
+                tokens=await count_tokens(latest_message),
+            )
+            # The user's message may have been resequenced; follow it. If it
+            # wasn't written, write it again together with the reply, so the
+            # reply never lands after a gap.
+            if await user_written:
+                reply_turn = Turn(
+                    bot_id=bot_id,
+                    seq=user_turn.seq + 1,
+                    messages=[assistant_message],
+                    on_written=release,
+                )
+            else:
+                reply_turn = Turn(
+                    bot_id=bot_id,
+                    seq=user_turn.seq,
+                    messages=[user_message, assistant_message],
+                    on_written=release,
+                )
+            await self.submit(reply_turn)
+            submitted = True
+        finally:
+            if not submitted and on_written is not None:
+                if queued and not user_written.done():
+                    # Let the next turn in only once it can read this message.
+                    user_turn.on_written = release
+                else:
+                    on_written()
+
+    async def _run(self):
+        while True:
+            batch = [await self.queue.get()]
+            while len(batch) < self.batch_size and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            PERSISTENCE_QUEUE_DEPTH.set(self.queue.qsize())
+            written: List[Turn] = []
+            try:
+                written = await self._write(batch)
+            finally:
+                for turn in batch:
+                    self.queue.task_done()
+                    if turn.on_written is not None:
+                        turn.on_written(any(turn is w for w in written))
+
+    async def _write(self, batch: List[Turn], resequence: bool = True) -> List[Turn]:
+        # Returns the turns that were written.
+        try:
+            async with SessionLocal() as db:
+                await persist_turns(db, batch)
+            return batch
+        except Exception as e:
+            if len(batch) == 1:
+                turn = batch[0]
+                if (
+                    isinstance(e, IntegrityError)
+                    and resequence
+                    and await self._resequence(turn)
+                ):
+                    return await self._write(batch, resequence=False)
+                logger.exception("failed to persist turn for bot %s", turn.bot_id)
+                return []
+            logger.exception("batched write failed, retrying turns one at a time")
+        # One bad turn shouldn't cost the rest of the batch.
+        written = []
+        for turn in batch:
+            written += await self._write([turn])
+        return written
+
+    async def _resequence(self, turn: Turn) -> bool:
+        # bot_turns only serializes turns within a process, so with several
+        # workers another turn on the bot may have been written since this one
+        # read the history. Append after it rather than losing the turn.
+        try:
+            async with SessionLocal() as db:
+                seq = await next_seq(db, turn.bot_id)
+        except Exception:
+            logger.exception("failed to resequence turn for bot %s", turn.bot_id)
+            return False
+        if seq == turn.seq:
+            return False
+        logger.warning(
+            "turn for bot %s moved from seq %d to %d", turn.bot_id, turn.seq, seq
+        )
+        turn.seq = seq
+        return True
+
+
+persistence_worker = PersistenceWorker()
@@ -0,0 +1,158 @@
+import os
+import time
+from dataclasses import dataclass
+from typing import List, Optional
+from uuid import UUID
+
+from fastapi import Response
+from sqlalchemy.exc import NoResultFound
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from app.cache import Lookup, lookup_cache
+from app.crud import lookup
+from app.database import REPLICA_PIN_SECONDS, ReplicaSessionLocal, SessionLocal
+from app.metrics import DB_READ_SESSIONS
+
+READ_PIN_COOKIE = "read_pin"
+# A pin for a turn that never finishes keeps the user's reads of that bot on the
+# primary until the cookie expires or their next turn replaces it.
+READ_PIN_MAX_AGE = int(os.getenv("READ_PIN_MAX_AGE", "3600"))
+READ_PIN_SECURE = os.getenv("ENV") != "dev"
+
+
+@dataclass(frozen=True)
+class ReadPin:
+    """What a user's reads must reflect after their last write.
+
+    It travels with the client as a cookie, so it holds whichever worker
+    serves their next read. Until ``until`` (wall clock) reads go to the
+    primary. After that the replica's answer is used only if it has bot
+    ``bot_id`` with at least ``messages`` messages. A forged pin can only move
+    its sender's own reads to the primary.
+    """
+
+    until: float
+    bot_id: Optional[UUID] = None
+    messages: int = 0
+
+    @classmethod
+    def after_write(
+        cls, bot_id: Optional[UUID] = None, messages: int = 0
+    ) -> "ReadPin":
+        return cls(time.time() + REPLICA_PIN_SECONDS, bot_id, messages)
+
+    def encode(self) -> str:
+        return f"{self.until:.3f}:{self.bot_id or ''}:{self.messages}"
+
+    @classmethod
+    def decode(cls, value: Optional[str]) -> Optional["ReadPin"]:
+        if not value:
+            return None
+        try:
+            until, bot_id, messages = value.split(":")
+            return cls(
+                until=min(float(until), time.time() + REPLICA_PIN_SECONDS),
+                bot_id=UUID(bot_id) if bot_id else None,
+                messages=int(messages),
+            )
+        except ValueError:
+            return None
+
+    def active(self) -> bool:
+        return time.time() < self.until
+
+    def satisfied_by(self, found: Lookup) -> bool:
+        if self.active():
+            return False
+        if self.bot_id is None:
+            return True
+        bot = found.bot
+        return (
+            bot is not None
+            and bot.id == self.bot_id
+            and bot.message_count >= self.messages
+        )
+
+
+def set_read_pin(response: Response, pin: ReadPin):
+    if ReplicaSessionLocal is None:
+        return
+    response.set_cookie(
+        READ_PIN_COOKIE,
+        pin.encode(),
+        max_age=READ_PIN_MAX_AGE,
+        httponly=True,
+        secure=READ_PIN_SECURE,
+        samesite="lax",
+    )
+
+
+class ReadSession:
+    """The database session of a read-only request.
+
+    Starts on the replica, if there is one and ``pin`` doesn't rule it out,
+    and moves to the primary when the replica is missing the user's data or
+    is behind their pin. Handlers query ``db`` once ``lookup`` has returned.
+    """
+
+    def __init__(self, pin: Optional[ReadPin]):
+        self.pin = pin
+        self.db: AsyncSession
+        self.on_primary = False
+        self._sessions: List[AsyncSession] = []
+        if ReplicaSessionLocal is None or (pin is not None and pin.active()):
+            self._open(SessionLocal, "primary")
+        else:
+            self._open(ReplicaSessionLocal, "replica")
+
+    def _open(self, factory: async_sessionmaker, database: str):
+        DB_READ_SESSIONS.labels(database=database).inc()
+        self.db = factory()
+        self.on_primary = database == "primary"
+        self._sessions.append(self.db)
+
+    def _fresh(self, found: Optional[Lookup], require_bot: bool) -> bool:
+        if found is None or (require_bot and found.bot is None):
+            return False
+        return self.pin is None or self.pin.satisfied_by(found)
+
+    async def lookup(
+        self,
+        clerk_id: str,
+        create_user: bool = False,
+        create_bot: bool = False,
+        require_bot: bool = False,
+    ) -> Lookup:
+        """crud.lookup, on the primary unless the replica's answer will do.
+
+        Anything that has to be created is created on the primary.
+        """
+        require_bot = require_bot or create_bot
+        stale = self.pin is not None and self.pin.active()
+        if not self.on_primary:
+            # A pin on a bot is checked against what the replica holds, not
+            # against a cached answer that may have come from the primary.
+            use_cache = self.pin is None or self.pin.bot_id is None
+            try:
+                found = await lookup(
+                    db=self.db, clerk_id=clerk_id, use_cache=use_cache
+                )
+            except NoResultFound:
+                found = None
+            if self._fresh(found, require_bot):
+                return found
+            self._open(SessionLocal, "primary")
+            stale = True
+        if stale:
+            # This worker's cached entry may predate a write made on another.
+            lookup_cache.invalidate(clerk_id)
+        return await lookup(
+            db=self.db,
+            clerk_id=clerk_id,
+            create_user=create_user,
+            create_bot=create_bot,
+        )
+
+    async def close(self):
+        for session in self._sessions:
+            await session.close()
@@ -1,9 +1,6 @@
-from typing import Optional
+from typing import List, Optional
 from uuid import UUID
-from pydantic import BaseModel, computed_field
-import tiktoken
-
-from app.lib import messages_from_context, tokens_for_context
+from pydantic import BaseModel
 
 
 class UserBase(BaseModel):
@@ -24,25 +21,37 @@ class User(UserBase):
 
 class BotBase(BaseModel):
     name: str
-    context: Optional[dict] = None
 
 
 class BotCreate(BotBase):
     creator_id: UUID
+    context: Optional[dict] = None
 
 
 class Bot(BotBase):
     id: UUID
     creator_id: UUID
-    creator: User
-
-    @computed_field
-    @property
-    def tokens(self) -> int:
-        return tokens_for_context(self.context)
+    tokens: int
+    message_count: int
 
     class Config:
         orm_mode = True
         json_encoders = {
             UUID: str,
         }
+
+
+class Message(BaseModel):
+    id: str
+    role: str
+    content: Optional[str] = None
+    tokens: int
+
+    class Config:
+        orm_mode = True
+
+
+class MessagePage(BaseModel):
+    messages: List[Message]
+    # Pass as ``before`` to get the next (older) page; null on the last one.
+    next: Optional[str] = None
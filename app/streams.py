@@ -0,0 +1,165 @@
+import asyncio
+import logging
+import os
+import time
+from bisect import bisect_right
+from typing import AsyncGenerator, Dict, List, Optional, Tuple
+
+from app.lib import Subscription
+from app.metrics import CHAT_OPEN_STREAMS
+
+REPLAY_TTL = float(os.getenv("REPLAY_TTL", "300"))
+RESUME_GRACE = float(os.getenv("RESUME_GRACE", "15"))
+
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+logger = logging.getLogger(__name__)
+
+
+def sse_event(data: str, id: Optional[str] = None, event: Optional[str] = None):
+    lines = []
+    if id is not None:
+        lines.append(f"id: {id}")
+    if event is not None:
+        lines.append(f"event: {event}")
+    lines.extend(f"data: {line}" for line in data.split("\n"))
+    return "\n".join(lines) + "\n\n"
+
+
+def parse_event_id(event_id: str) -> Optional[Tuple[str, int]]:
+    message_id, _, offset = event_id.rpartition(":")
+    if not message_id or not offset.isdigit():
+        return None
+    return message_id, int(offset)
+
+
+class ReplayEntry:
+    """The chunks streamed so far for one assistant reply.
+
+    Event ids are ``<message_id>:<offset>``, where offset is the number of
+    characters of the reply the client has received, so a reconnect can pick
+    up from there. While no client is attached the upstream is kept alive for
+    RESUME_GRACE seconds before the recording subscription lets go of it.
+    """
+
+    def __init__(self, message_id: str, owner: str, subscription: Subscription):
+        self.message_id = message_id
+        self.owner = owner
+        self.chunks: List[str] = []
+        self.ends: List[int] = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.expires_at: Optional[float] = None
+        self.listeners = 0
+        self._subscription = subscription
+        self._changed = asyncio.Event()
+        self._grace: Optional[asyncio.TimerHandle] = None
+        self._task = asyncio.create_task(self._record())
+        self._arm_grace()
+
+    @property
+    def length(self) -> int:
+        return self.ends[-1] if self.ends else 0
+
+    async def _record(self):
+        try:
+            async for chunk in self._subscription:
+                self.chunks.append(chunk)
+                self.ends.append(self.length + len(chunk))
+                self._notify()
+        except Exception as e:
+            self.error = e
+        finally:
+            self.done = True
+            self.expires_at = time.monotonic() + REPLAY_TTL
+            if self._grace is not None:
+                self._grace.cancel()
+            self._notify()
+
+    def _notify(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def _arm_grace(self):
+        if self._grace is None and not self.done:
+            loop = asyncio.get_running_loop()
+            self._grace = loop.call_later(RESUME_GRACE, self._abandon)
+
+    def _abandon(self):
+        self._grace = None
+        if self.listeners == 0 and not self.done:
+            logger.info("releasing upstream for abandoned %s", self.message_id)
+            self._subscription.close()
+
+    async def events(self, offset: int = 0) -> AsyncGenerator[str, None]:
+        self.listeners += 1
+        CHAT_OPEN_STREAMS.inc()
+        if self._grace is not None:
+            self._grace.cancel()
+            self._grace = None
+        try:
+            index = bisect_right(self.ends, offset)
+            while True:
+                while index < len(self.chunks):
+                    chunk, end = self.chunks[index], self.ends[index]
+                    # Offsets normally land on chunk boundaries; trim if not.
+                    start = end - len(chunk)
+                    if offset > start:
+                        chunk = chunk[offset - start :]
+                    yield sse_event(chunk, id=f"{self.message_id}:{end}")
+                    offset = end
+                    index += 1
+                if self.done:
+                    break
+                await self._changed.wait()
+            if self.error is not None:
+                yield sse_event("upstream error", event="error")
+            else:
+                yield sse_event("", id=f"{self.message_id}:{offset}", event="done")
+        finally:
+            CHAT_OPEN_STREAMS.dec()
+            self.listeners -= 1
+            if self.listeners == 0:
+                self._arm_grace()
+
+
+class ReplayBuffer:
+    def __init__(self):
+        self.entries: Dict[str, ReplayEntry] = {}
+
+    def record(
+        self, message_id: str, owner: str, subscription: Subscription
+    ) -> ReplayEntry:
+        self._sweep()
+        entry = ReplayEntry(message_id, owner, subscription)
+        self.entries[message_id] = entry
+        return entry
+
+    def resume(
+        self, last_event_id: str, owner: str
+    ) -> Optional[AsyncGenerator[str, None]]:
+        self._sweep()
+        parsed = parse_event_id(last_event_id)
+        if parsed is None:
+            return None
+        message_id, offset = parsed
+        entry = self.entries.get(message_id)
+        if entry is None or entry.owner != owner or offset > entry.length:
+            return None
+        if entry.done and offset == entry.length:
+            # Nothing left to send; a 204 stops EventSource reconnecting.
+            return None
+        return entry.events(offset)
+
+    def _sweep(self):
+        now = time.monotonic()
+        expired = [
+            message_id
+            for message_id, entry in self.entries.items()
+            if entry.expires_at is not None and entry.expires_at <= now
+        ]
+        for message_id in expired:
+            del self.entries[message_id]
+
+
+replay_buffer = ReplayBuffer()
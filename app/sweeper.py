@@ -0,0 +1,98 @@
+import asyncio
+import logging
+import os
+import random
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+
+from app.crud import delete_archived_bots, mark_expired_bots
+from app.database import SessionLocal
+from app.metrics import EXPIRED_BOTS_DELETED
+
+MAX_TOKENS = 4096  # TODO: make sure this aligns with the frontend
+BOT_SWEEP_INTERVAL = float(os.getenv("BOT_SWEEP_INTERVAL", "60"))
+BOT_SWEEP_BATCH_SIZE = int(os.getenv("BOT_SWEEP_BATCH_SIZE", "500"))
+# How long an expired bot is kept for a user who hasn't been back to hear its
+# farewell.
+BOT_EXPIRED_GRACE = float(os.getenv("BOT_EXPIRED_GRACE", str(30 * 24 * 3600)))
+
+logger = logging.getLogger(__name__)
+
+
+class BotSweeper:
+    """Archives bots that have used up MAX_TOKENS and deletes them later.
+
+    A sweep runs every BOT_SWEEP_INTERVAL seconds, or sooner when a request
+    that came across an expired bot calls wake(). It stamps expired_at on
+    bots that reached MAX_TOKENS, then deletes those whose farewell /bot has
+    delivered or that expired over BOT_EXPIRED_GRACE seconds ago, so a user
+    who returns in between still gets the farewell. Each batch is one
+    indexed query and one write, so a backlog is cleared without holding a
+    long transaction.
+    """
+
+    def __init__(
+        self,
+        interval: float = BOT_SWEEP_INTERVAL,
+        batch_size: int = BOT_SWEEP_BATCH_SIZE,
+        max_tokens: int = MAX_TOKENS,
+        grace: float = BOT_EXPIRED_GRACE,
+    ):
+        self.interval = interval
+        self.batch_size = batch_size
+        self.max_tokens = max_tokens
+        self.grace = grace
+        self._wake = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def wake(self):
+        self._wake.set()
+
+    async def sweep(self) -> int:
+        while True:
+            async with SessionLocal() as db:
+                marked = await mark_expired_bots(
+                    db, max_tokens=self.max_tokens, limit=self.batch_size
+                )
+            if marked < self.batch_size:
+                break
+        expired_before = datetime.now(timezone.utc) - timedelta(seconds=self.grace)
+        deleted = 0
+        while True:
+            async with SessionLocal() as db:
+                bot_ids = await delete_archived_bots(
+                    db, expired_before=expired_before, limit=self.batch_size
+                )
+            deleted += len(bot_ids)
+            EXPIRED_BOTS_DELETED.inc(len(bot_ids))
+            if len(bot_ids) < self.batch_size:
+                return deleted
+
+    async def _run(self):
+        while True:
+            # Jittered so that several workers' sweepers don't run in step.
+            timeout = self.interval * random.uniform(0.75, 1.25)
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            try:
+                deleted = await self.sweep()
+            except Exception:
+                logger.exception("failed to sweep expired bots")
+                continue
+            if deleted:
+                logger.info("deleted %d expired bots", deleted)
+
+
+bot_sweeper = BotSweeper()
@@ -1,24 +1,81 @@
 from dataclasses import dataclass
-from typing import Union
-from openai.types.chat import (
-    ChatCompletionAssistantMessageParam,
-    ChatCompletionUserMessageParam,
-)
+from typing import Callable, List, Literal, Optional, Required, TypedDict, Union
 
 from uuid import UUID
 
+from app import compression
 
-@dataclass
-class ChatCompletionAssistantMessageParamID(ChatCompletionAssistantMessageParam):
-    id: str  # UUID
 
+# The same shape as openai's ChatCompletion*MessageParam, declared here so
+# that importing the app's types doesn't load the whole openai package.
+class ChatCompletionAssistantMessageParam(TypedDict, total=False):
+    role: Required[Literal["assistant"]]
+    content: Optional[str]
 
-@dataclass
-class ChatCompletionUserMessageParamID(ChatCompletionUserMessageParam):
-    id: str  # UUID
+
+class ChatCompletionUserMessageParam(TypedDict, total=False):
+    role: Required[Literal["user"]]
+    content: Required[str]
 
 
-ChatCompletionMessageParamID = Union[
-    ChatCompletionAssistantMessageParamID,
-    ChatCompletionUserMessageParamID,
+ChatCompletionMessageParam = Union[
+    ChatCompletionAssistantMessageParam,
+    ChatCompletionUserMessageParam,
 ]
+
+
+ROLES = ("user", "assistant")
+
+
+class ChatMessage:
+    """A message of a conversation, from storage through to the upstream payload.
+
+    Loading a long history only needs the roles and token counts, so
+    compressed content is inflated on first access, and the upstream payload
+    is built only for the messages that make it into a prompt.
+    """
+
+    __slots__ = ("role", "id", "tokens", "_content", "_content_z", "_payload")
+
+    def __init__(
+        self,
+        role: str,
+        content: Optional[str],
+        id: str,
+        tokens: int,
+        content_z: Optional[bytes] = None,
+    ):
+        if role not in ROLES:
+            raise ValueError(f"unexpected message role {role!r}")
+        self.role = role
+        self.id = id
+        self.tokens = tokens
+        self._content = content
+        self._content_z = content_z
+        self._payload: Optional[ChatCompletionMessageParam] = None
+
+    @property
+    def content(self) -> Optional[str]:
+        if self._content_z is not None:
+            self._content = compression.decompress_text(self._content_z)
+            self._content_z = None
+        return self._content
+
+    @property
+    def payload(self) -> ChatCompletionMessageParam:
+        payload = self._payload
+        if payload is None:
+            payload = self._payload = {
+                "role": self.role,  # type: ignore[typeddict-item]
+                "content": self.content or "",
+            }
+        return payload
+
+
+@dataclass
+class Turn:
+    bot_id: UUID
+    seq: int  # sequence number of the first message
+    messages: List[ChatMessage]
+    # Called once the turn has been written (True) or given up on (False).
+    on_written: Optional[Callable[[bool], None]] = None
@@ -0,0 +1,13 @@
+import os
+
+from uvicorn_worker import UvicornWorker
+
+# How long a stopping worker lets open /chat streams run before cutting them.
+STREAM_DRAIN_TIMEOUT = int(os.getenv("STREAM_DRAIN_TIMEOUT", "60"))
+
+
+class Worker(UvicornWorker):
+    CONFIG_KWARGS = {
+        **UvicornWorker.CONFIG_KWARGS,
+        "timeout_graceful_shutdown": STREAM_DRAIN_TIMEOUT,
+    }
@@ -0,0 +1,87 @@
+"""Bearer token verification latency against a local JWKS stand-in.
+
+    CLERK_JWT_ISSUER=http://localhost python -m bench.auth [--requests N]
+
+Serves a freshly generated RSA key from a local HTTP server and compares
+the old PyJWKClient path with app.auth's JWKS client and verified-token
+cache.
+"""
+import argparse
+import asyncio
+import statistics
+import time
+from typing import Awaitable, Callable, List
+
+import jwt
+
+from app.auth import JWKSClient, TokenVerifier
+from bench.jwks import KID, generate_key, serve_jwks
+
+
+def report(name: str, samples: List[float]):
+    samples = sorted(samples)
+    p50 = statistics.median(samples) * 1e6
+    p99 = samples[max(0, int(len(samples) * 0.99) - 1)] * 1e6
+    print(f"{name:>28}: p50 {p50:>9.1f} us  p99 {p99:>9.1f} us")
+
+
+async def timed(call: Callable[[], Awaitable], n: int) -> List[float]:
+    samples = []
+    for _ in range(n):
+        start = time.perf_counter()
+        await call()
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+async def main(requests: int):
+    private_key, jwk = generate_key()
+    server = serve_jwks({"keys": [jwk]})
+    issuer = f"http://127.0.0.1:{server.server_address[1]}"
+    url = f"{issuer}/.well-known/jwks.json"
+
+    def token() -> str:
+        claims = {"sub": "user_bench", "iss": issuer, "exp": int(time.time()) + 60}
+        claims["iat"] = time.time()  # unique per call, so nothing is cached
+        return jwt.encode(
+            claims, private_key, algorithm="RS256", headers={"kid": KID}
+        )
+
+    session_token = token()
+
+    legacy = jwt.PyJWKClient(url)
+
+    async def legacy_verify(t: str):
+        key = legacy.get_signing_key_from_jwt(t).key
+        jwt.decode(t, key, algorithms=["RS256"], issuer=issuer)
+
+    verifier = TokenVerifier(JWKSClient(url), issuer)
+    tokens = [token() for _ in range(requests)]
+
+    report("PyJWKClient, cold", await timed(lambda: legacy_verify(tokens[0]), 1))
+    report("TokenVerifier, cold", await timed(lambda: verifier.verify(tokens[0]), 1))
+
+    fresh = iter(tokens)
+    report(
+        "PyJWKClient, same token",
+        await timed(lambda: legacy_verify(session_token), requests),
+    )
+    report(
+        "TokenVerifier, new tokens",
+        await timed(lambda: verifier.verify(next(fresh)), requests),
+    )
+    await verifier.verify(session_token)
+    report(
+        "TokenVerifier, same token",
+        await timed(lambda: verifier.verify(session_token), requests),
+    )
+
+    await verifier.jwks_client.aclose()
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=2000)
+    args = parser.parse_args()
+    asyncio.run(main(args.requests))
@@ -0,0 +1,106 @@
+"""Compare app.lib.Broadcast against the queue-per-consumer tee it replaced.
+
+    python -m bench.broadcast [--items N] [--consumers N]
+
+Reports items/sec with every consumer keeping up, and peak traced memory
+when one consumer is slow (the old tee buffers the whole stream for it).
+"""
+import argparse
+import asyncio
+import time
+import tracemalloc
+from typing import AsyncGenerator, Tuple
+
+from app.lib import Broadcast
+
+
+async def legacy_tee(
+    generator: AsyncGenerator, n: int = 2
+) -> Tuple[AsyncGenerator, ...]:
+    queues = [asyncio.Queue() for _ in range(n)]
+
+    async def distribute():
+        async for item in generator:
+            for queue in queues:
+                await queue.put(item)
+        for queue in queues:
+            await queue.put(None)
+
+    asyncio.create_task(distribute())
+    return tuple(_queue_to_async_gen(queue) for queue in queues)
+
+
+async def _queue_to_async_gen(queue: asyncio.Queue) -> AsyncGenerator:
+    while True:
+        item = await queue.get()
+        if item is None:
+            break
+        yield item
+
+
+async def source(items: int) -> AsyncGenerator[str, None]:
+    for i in range(items):
+        yield f"token {i} "
+        if i % 64 == 0:
+            # Upstream chunks arrive over the network, not all at once.
+            await asyncio.sleep(0)
+
+
+async def drain(consumer, delay: float = 0.0) -> int:
+    count = 0
+    async for _ in consumer:
+        count += 1
+        if delay and count % 64 == 0:
+            await asyncio.sleep(delay)
+    return count
+
+
+async def tee_consumers(items: int, consumers: int):
+    return await legacy_tee(source(items), consumers)
+
+
+async def broadcast_consumers(items: int, consumers: int):
+    broadcast = Broadcast(source(items))
+    subscriptions = [broadcast.subscribe() for _ in range(consumers)]
+    broadcast.start()
+    return subscriptions
+
+
+async def measure(
+    make, items: int, consumers: int, slow_delay: float, trace: bool = False
+):
+    if trace:
+        tracemalloc.start()
+    start = time.perf_counter()
+    subscribers = await make(items, consumers)
+    delays = [0.0] * consumers
+    delays[-1] = slow_delay
+    counts = await asyncio.gather(
+        *(drain(s, d) for s, d in zip(subscribers, delays))
+    )
+    elapsed = time.perf_counter() - start
+    peak = 0
+    if trace:
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    assert all(c == items for c in counts), counts
+    return items / elapsed, peak
+
+
+async def main(items: int, consumers: int):
+    for name, make in (("tee", tee_consumers), ("broadcast", broadcast_consumers)):
+        rate, _ = await measure(make, items, consumers, slow_delay=0.0)
+        _, peak = await measure(make, items, consumers, 0.0, trace=True)
+        _, slow_peak = await measure(make, items, consumers, 0.001, trace=True)
+        print(
+            f"{name:>10}: {rate:>12,.0f} items/s  peak {peak / 1024:>8.1f} KiB"
+            f"  peak with slow consumer {slow_peak / 1024:>8.1f} KiB"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--items", type=int, default=100_000)
+    parser.add_argument("--consumers", type=int, default=2)
+    args = parser.parse_args()
+    asyncio.run(main(args.items, args.consumers))
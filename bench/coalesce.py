@@ -0,0 +1,84 @@
+"""Writes per response with and without app.lib.coalesce.
+
+    python -m bench.coalesce [--responses N] [--deltas N]
+
+Simulates an upstream that emits a few characters every couple of
+milliseconds, the way OpenAI deltas arrive, and pushes it through the same
+Broadcast and replay/SSE framing that /chat uses. Reports how many events
+reach the response writer, how long the first one takes, and the total
+time per response.
+"""
+import argparse
+import asyncio
+import random
+import statistics
+import time
+from typing import AsyncGenerator
+
+from app.lib import Broadcast, coalesce
+from app.streams import ReplayBuffer
+
+
+async def upstream(deltas: int, seed: int) -> AsyncGenerator[str, None]:
+    rng = random.Random(seed)
+    await asyncio.sleep(0.05)  # time to first token
+    for _ in range(deltas):
+        yield "".join(rng.choice("abcdefgh ") for _ in range(rng.randint(1, 6)))
+        await asyncio.sleep(rng.uniform(0.001, 0.004))
+
+
+async def respond(stream, replay_buffer: ReplayBuffer, id: str) -> tuple:
+    start = time.perf_counter()
+    broadcast = Broadcast(stream)
+    accumulator = broadcast.subscribe(interested=False)
+    replay = replay_buffer.record(
+        id, owner="bench", subscription=broadcast.subscribe()
+    )
+    broadcast.start()
+    drain = asyncio.create_task(_drain(accumulator))
+
+    first = None
+    writes = 0
+    async for event in replay.events():
+        if first is None:
+            first = time.perf_counter() - start
+        writes += 1
+        await asyncio.sleep(0)  # stands in for the ASGI send
+    await drain
+    # The trailing "done" event isn't a chunk of the reply.
+    return writes - 1, first, time.perf_counter() - start
+
+
+async def _drain(subscription):
+    async for _ in subscription:
+        pass
+
+
+async def run(responses: int, deltas: int, coalesced: bool):
+    replay_buffer = ReplayBuffer()
+    streams = [upstream(deltas, seed) for seed in range(responses)]
+    if coalesced:
+        streams = [coalesce(s) for s in streams]
+    results = await asyncio.gather(
+        *(respond(s, replay_buffer, str(i)) for i, s in enumerate(streams))
+    )
+    writes, firsts, totals = zip(*results)
+    label = "coalesced" if coalesced else "raw"
+    print(
+        f"{label:>10}: {statistics.mean(writes):>7.1f} writes/response"
+        f"  first chunk {statistics.median(firsts) * 1000:>6.1f} ms"
+        f"  total {statistics.median(totals) * 1000:>7.1f} ms"
+    )
+
+
+async def main(responses: int, deltas: int):
+    await run(responses, deltas, coalesced=False)
+    await run(responses, deltas, coalesced=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--responses", type=int, default=50)
+    parser.add_argument("--deltas", type=int, default=300)
+    args = parser.parse_args()
+    asyncio.run(main(args.responses, args.deltas))
@@ -0,0 +1,303 @@
+"""Concurrent /chat load against a local stack.
+
+    python -m bench.loadtest [--clients N] [--turns N] [--workers N]
+
+Starts app.fake_llm, a JWKS stand-in and the app itself, served by gunicorn
+with --workers processes and migrated onto a throwaway sqlite database unless
+--database-url is given. Each client then signs in as its own user and holds
+a conversation over /chat's SSE stream. Reports time to first byte, stream
+latency, tokens/sec and errors, and the app's event loop lag from /metrics.
+The fake model emits one word per token, so tokens are counted as words.
+
+--message-words pads every message to make tokenizing it expensive, and
+--history has each client fetch its last 200 messages after every turn.
+"""
+import argparse
+import asyncio
+import os
+import re
+import secrets
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+from dataclasses import dataclass, field
+from typing import List, Optional, Tuple
+
+import httpx
+import jwt
+
+from bench.jwks import KID, generate_key, serve_jwks
+
+GUNICORN_CONF = os.path.join(os.path.dirname(__file__), "..", "gunicorn.conf.py")
+
+
+@dataclass
+class Results:
+    ttfb: List[float] = field(default_factory=list)
+    latency: List[float] = field(default_factory=list)
+    tokens: List[int] = field(default_factory=list)
+    errors: Counter = field(default_factory=Counter)
+    turns: int = 0
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def loop_lag(metrics: str) -> Optional[Tuple[float, float, int]]:
+    """Mean and p99 (a bucket bound) of event_loop_lag_seconds, and the count."""
+    buckets = [
+        (float(match[1]), float(match[2]))
+        for match in re.finditer(
+            r'^event_loop_lag_seconds_bucket\{le="([^"]+)"\} (\S+)$', metrics, re.M
+        )
+    ]
+    total = re.search(r"^event_loop_lag_seconds_sum (\S+)$", metrics, re.M)
+    if not buckets or total is None or buckets[-1][1] == 0:
+        return None
+    count = buckets[-1][1]
+    p99 = next(bound for bound, seen in buckets if seen >= count * 0.99)
+    return float(total[1]) / count, p99, int(count)
+
+
+def percentile(samples: List[float], q: float) -> float:
+    samples = sorted(samples)
+    return samples[max(0, int(len(samples) * q + 0.5) - 1)]
+
+
+async def wait_until_up(url: str, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while True:
+            try:
+                await client.get(url)
+                return
+            except httpx.TransportError:
+                if time.monotonic() > deadline:
+                    raise RuntimeError(f"{url} did not come up")
+                await asyncio.sleep(0.2)
+
+
+async def chat_turn(
+    client: httpx.AsyncClient, headers: dict, message: str, results: Results
+):
+    results.turns += 1
+    start = time.perf_counter()
+    ttfb: Optional[float] = None
+    text, event, data = "", None, []
+    try:
+        async with client.stream(
+            "GET", "/chat", params={"message": message}, headers=headers
+        ) as response:
+            if response.status_code != 200:
+                results.errors[f"http {response.status_code}"] += 1
+                return
+            async for line in response.aiter_lines():
+                if ttfb is None:
+                    ttfb = time.perf_counter() - start
+                if line.startswith("event: "):
+                    event = line[len("event: ") :]
+                elif line.startswith("data: "):
+                    data.append(line[len("data: ") :])
+                elif line == "":
+                    if event == "error":
+                        results.errors["upstream error"] += 1
+                        return
+                    if event is None:
+                        text += "\n".join(data)
+                    data = []
+    except httpx.HTTPError as e:
+        results.errors[type(e).__name__] += 1
+        return
+    if event != "done":
+        results.errors["incomplete stream"] += 1
+        return
+    results.ttfb.append(ttfb)
+    results.latency.append(time.perf_counter() - start)
+    results.tokens.append(len(text.split()))
+
+
+async def converse(
+    client: httpx.AsyncClient,
+    token: str,
+    index: int,
+    turns: int,
+    think_time: float,
+    message_words: int,
+    history: bool,
+    results: Results,
+):
+    headers = {"Authorization": f"Bearer {token}"}
+    padding = " lorem" * message_words
+    for path in ("/me", "/bot"):
+        response = await client.get(path, headers=headers)
+        if response.status_code != 200:
+            results.errors[f"setup {path} {response.status_code}"] += 1
+            return
+    for turn in range(turns):
+        message = f"hello from {index}, turn {turn}{padding}"
+        await chat_turn(client, headers, message, results)
+        if history:
+            response = await client.get(
+                "/bot/messages", params={"limit": 200}, headers=headers
+            )
+            if response.status_code != 200:
+                results.errors[f"history {response.status_code}"] += 1
+        # A user reading the reply before typing the next message.
+        await asyncio.sleep(think_time)
+
+
+def report(results: Results, elapsed: float, metrics: str):
+    failed = sum(results.errors.values())
+    print(f"{results.turns} turns in {elapsed:.1f}s, {failed} failed")
+    for kind, count in results.errors.most_common():
+        print(f"  {kind}: {count}")
+    if not results.latency:
+        return
+    for name, samples in (("ttfb", results.ttfb), ("latency", results.latency)):
+        p50 = percentile(samples, 0.5) * 1000
+        p99 = percentile(samples, 0.99) * 1000
+        print(f"{name:>10}: p50 {p50:>8.1f} ms  p99 {p99:>8.1f} ms")
+    rates = [
+        tokens / (latency - ttfb)
+        for tokens, latency, ttfb in zip(results.tokens, results.latency, results.ttfb)
+        if latency > ttfb
+    ]
+    if rates:
+        print(f"{'tokens/s':>10}: {statistics.median(rates):.1f} per stream (median)")
+    print(f"{'':>10}  {sum(results.tokens) / elapsed:.1f} across all streams")
+    print(f"{'error rate':>10}: {failed / results.turns:.2%}")
+    lag = loop_lag(metrics)
+    if lag is not None:
+        mean, p99, count = lag
+        print(
+            f"{'loop lag':>10}: mean {mean * 1000:.2f} ms  "
+            f"p99 <= {p99 * 1000:g} ms ({count} samples)"
+        )
+
+
+async def run(
+    args: argparse.Namespace,
+    base_url: str,
+    issuer: str,
+    private_key,
+    metrics_token: str,
+):
+    def token(sub: str) -> str:
+        claims = {"sub": sub, "iss": issuer, "exp": int(time.time()) + 3600}
+        return jwt.encode(claims, private_key, algorithm="RS256", headers={"kid": KID})
+
+    await wait_until_up(base_url)
+    results = Results()
+    limits = httpx.Limits(max_connections=args.clients)
+    timeout = httpx.Timeout(60.0)
+    async with httpx.AsyncClient(
+        base_url=base_url, limits=limits, timeout=timeout
+    ) as client:
+        start = time.perf_counter()
+        await asyncio.gather(
+            *(
+                converse(
+                    client,
+                    token(f"user_loadtest_{i}"),
+                    i,
+                    args.turns,
+                    args.think_time,
+                    args.message_words,
+                    args.history,
+                    results,
+                )
+                for i in range(args.clients)
+            )
+        )
+        elapsed = time.perf_counter() - start
+        scrape = {"Authorization": f"Bearer {metrics_token}"}
+        metrics = (await client.get("/metrics", headers=scrape)).text
+    report(results, elapsed, metrics)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--clients", type=int, default=50)
+    parser.add_argument("--turns", type=int, default=3)
+    parser.add_argument("--think-time", type=float, default=0.5)
+    parser.add_argument("--message-words", type=int, default=0)
+    parser.add_argument("--history", action="store_true")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--database-url")
+    parser.add_argument("--tokens-per-second", type=float, default=50)
+    parser.add_argument("--latency-ms", type=float, default=300)
+    parser.add_argument("--reply-tokens", type=int, default=60)
+    parser.add_argument("--failure-rate", type=float, default=0)
+    parser.add_argument("--slow-rate", type=float, default=0)
+    parser.add_argument("--slow-ms", type=float, default=5000)
+    args = parser.parse_args()
+
+    private_key, jwk = generate_key()
+    jwks = serve_jwks({"keys": [jwk]})
+    issuer = f"http://127.0.0.1:{jwks.server_address[1]}"
+
+    tmp = tempfile.TemporaryDirectory()
+    database_url = args.database_url or f"sqlite:///{tmp.name}/loadtest.db"
+    llm_port, app_port = free_port(), free_port()
+    env = {
+        **os.environ,
+        "DATABASE_URL": database_url,
+        "CLERK_JWT_ISSUER": issuer,
+        "OPENAI_BASE_URL": f"http://127.0.0.1:{llm_port}/v1",
+        "OPENAI_API_KEY": "fake",
+        "LLM_BACKEND": "openai",
+        "ENV": "loadtest",
+        "METRICS_TOKEN": secrets.token_hex(16),
+    }
+    bin_dir = os.path.dirname(sys.executable)
+    subprocess.run(
+        # Not `python -m alembic`: the repo's alembic/ directory shadows it.
+        [os.path.join(bin_dir, "alembic"), "upgrade", "head"],
+        env=env,
+        check=True,
+    )
+
+    # fmt: off
+    processes = [
+        subprocess.Popen([
+            sys.executable, "-m", "app.fake_llm", "--port", str(llm_port),
+            "--tokens-per-second", str(args.tokens_per_second),
+            "--latency-ms", str(args.latency_ms),
+            "--reply-tokens", str(args.reply_tokens),
+            "--failure-rate", str(args.failure_rate),
+            "--slow-rate", str(args.slow_rate), "--slow-ms", str(args.slow_ms),
+        ], env=env),
+        subprocess.Popen([
+            os.path.join(bin_dir, "gunicorn"), "app.main:app",
+            "--config", GUNICORN_CONF, "--bind", f"127.0.0.1:{app_port}",
+            "--log-level", "warning",
+        ], env={**env, "WEB_CONCURRENCY": str(args.workers)}),
+    ]
+    # fmt: on
+    try:
+        asyncio.run(
+            run(
+                args,
+                f"http://127.0.0.1:{app_port}",
+                issuer,
+                private_key,
+                env["METRICS_TOKEN"],
+            )
+        )
+    finally:
+        for process in processes:
+            process.terminate()
+            process.wait()
+        jwks.shutdown()
+        tmp.cleanup()
+
+
+if __name__ == "__main__":
+    main()
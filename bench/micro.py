@@ -0,0 +1,237 @@
+"""Micro-benchmarks for the helpers on the request hot path.
+
+    python -m bench.micro [--filter TEXT] [--memory] [--save PATH] [--compare PATH]
+
+Each helper is timed against single messages of a few sizes or synthetic
+conversations from 10 messages up to the 128k-token context limit, built from
+the fake model's words (one token each). Every case is repeated --repeats
+times, each repeat long enough to measure (see timeit.Timer.autorange), and
+reported as the median time per call. With --memory each case also reports
+the peak memory allocated by one call (traced separately, so it doesn't slow
+the timings).
+
+--save writes the results to a JSON baseline. --compare reads one, prints
+each case's change against it and exits with status 1 if any case got slower
+by more than --threshold. Baselines are only comparable on the machine (and
+tokenizer) that produced them.
+"""
+import argparse
+import asyncio
+import datetime
+import functools
+import inspect
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import timeit
+import tracemalloc
+import uuid
+from typing import Callable, Dict, Iterator, List, Tuple
+
+tmp = tempfile.TemporaryDirectory()
+# app.context imports the database setup, though nothing here connects to it.
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{tmp.name}/micro.db")
+
+from app import schemas  # noqa: E402
+from app.ai import transform_to_openai_type  # noqa: E402
+from app.context import assemble_context  # noqa: E402
+from app.fake_llm import fake_reply  # noqa: E402
+from app.lib import Broadcast, count_tokens, tokens_for_text  # noqa: E402
+from app.types import ChatMessage  # noqa: E402
+
+# Message counts; user turns are 40 tokens and replies 280, so 800 messages
+# is the 128k-token limit.
+CONVERSATIONS = (("10 messages", 10), ("100 messages", 100), ("128k tokens", 800))
+# Token counts of messages tokenized on the request path: a user message, a
+# reply, and a long paste that count_tokens sends to the CPU pool.
+MESSAGE_TOKENS = (40, 280, 4000)
+BROADCAST_CHUNKS = (100, 1000, 10000)
+PAGE_SIZES = (50, 200)
+
+
+def conversation(count: int) -> List[dict]:
+    messages = []
+    for i in range(count):
+        role = "user" if i % 2 == 0 else "assistant"
+        tokens = 40 if role == "user" else 280
+        content = " ".join(fake_reply([{"role": "user", "content": f"{i}"}], tokens))
+        id = str(uuid.uuid4())
+        messages.append({"role": role, "content": content, "id": id, "tokens": tokens})
+    return messages
+
+
+def records(rows: List[tuple]) -> List[ChatMessage]:
+    # What crud.get_messages does with the columns it selects.
+    return [ChatMessage(*row) for row in rows]
+
+
+def prompt(rows: List[tuple], message: ChatMessage) -> list:
+    # /chat's work between loading the history and calling upstream.
+    messages = records(rows)
+    messages.append(message)
+    window = assemble_context(messages)
+    return transform_to_openai_type(window.messages)
+
+
+async def fan_out(chunks: List[str], consumers: int):
+    async def source():
+        for chunk in chunks:
+            yield chunk
+
+    async def drain(subscription):
+        async for _ in subscription:
+            pass
+
+    broadcast = Broadcast(source())
+    subscriptions = [broadcast.subscribe() for _ in range(consumers)]
+    broadcast.start()
+    await asyncio.gather(*(drain(s) for s in subscriptions))
+
+
+def serialize(model, data: dict) -> str:
+    return model.model_validate(data).model_dump_json()
+
+
+def cases() -> Iterator[Tuple[str, Callable]]:
+    partial = functools.partial
+    for tokens in MESSAGE_TOKENS:
+        text = " ".join(fake_reply([{"role": "user", "content": "hi"}], tokens))
+        yield f"tokens_for_text[{tokens} tokens]", partial(tokens_for_text, text)
+        yield f"count_tokens[{tokens} tokens]", partial(count_tokens, text)
+
+    for label, count in CONVERSATIONS:
+        messages = conversation(count)
+        rows = [(m["role"], m["content"], m["id"], m["tokens"], None) for m in messages]
+        message = ChatMessage("user", messages[0]["content"], str(uuid.uuid4()), 40)
+        yield f"ChatMessage[{label}]", partial(records, rows)
+        yield f"prompt[{label}]", partial(prompt, rows, message)
+
+    for chunks in BROADCAST_CHUNKS:
+        deltas = [f"token {i} " for i in range(chunks)]
+        yield f"Broadcast[2 consumers, {chunks} chunks]", partial(fan_out, deltas, 2)
+
+    bot = {
+        "id": uuid.uuid4(),
+        "name": "Ada",
+        "creator_id": uuid.uuid4(),
+        "tokens": 1234,
+        "message_count": 42,
+    }
+    yield "schemas.Bot", partial(serialize, schemas.Bot, bot)
+    messages = conversation(max(PAGE_SIZES))
+    for size in PAGE_SIZES:
+        page = {"messages": messages[:size], "next": messages[size - 1]["id"]}
+        yield (
+            f"schemas.MessagePage[{size} messages]",
+            partial(serialize, schemas.MessagePage, page),
+        )
+
+
+def measure(
+    fn: Callable, loop: asyncio.AbstractEventLoop, repeats: int, memory: bool
+) -> dict:
+    if inspect.iscoroutinefunction(fn):
+        call = lambda: loop.run_until_complete(fn())  # noqa: E731
+    else:
+        call = fn
+    timer = timeit.Timer(call)
+    number, _ = timer.autorange()
+    samples = [elapsed / number for elapsed in timer.repeat(repeats, number)]
+    result = {
+        "median": statistics.median(samples),
+        "min": min(samples),
+        "number": number,
+    }
+    if memory:
+        tracemalloc.start()
+        call()
+        result["peak_bytes"] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return result
+
+
+def format_bytes(size: float) -> str:
+    for unit in ("B", "KiB", "MiB"):
+        if size < 1024:
+            break
+        size /= 1024
+    return f"{size:.1f} {unit}"
+
+
+def format_time(seconds: float) -> str:
+    for unit, scale in (("s", 1), ("ms", 1e-3), ("us", 1e-6)):
+        if seconds >= scale:
+            return f"{seconds / scale:.2f} {unit}"
+    return f"{seconds / 1e-9:.0f} ns"
+
+
+def change(result: dict, baseline: dict, threshold: float) -> Tuple[str, bool]:
+    ratio = result["median"] / baseline["median"]
+    note = f"{ratio - 1:+.1%}"
+    if ratio > 1 + threshold:
+        return f"{note}  REGRESSION", True
+    if ratio < 1 - threshold:
+        return f"{note}  faster", False
+    return note, False
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--filter", default="", help="only cases containing this")
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--memory", action="store_true")
+    parser.add_argument("--save", metavar="PATH")
+    parser.add_argument("--compare", metavar="PATH")
+    parser.add_argument("--threshold", type=float, default=0.10)
+    args = parser.parse_args()
+
+    baseline: Dict[str, dict] = {}
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["results"]
+
+    loop = asyncio.new_event_loop()
+    results: Dict[str, dict] = {}
+    regressions = 0
+    for name, fn in cases():
+        if args.filter not in name:
+            continue
+        results[name] = result = measure(fn, loop, args.repeats, args.memory)
+        line = f"{name:<48} {format_time(result['median']):>10}"
+        if args.memory:
+            line += f" {format_bytes(result['peak_bytes']):>11}"
+        if args.compare:
+            if name in baseline:
+                note, regressed = change(result, baseline[name], args.threshold)
+                regressions += regressed
+            else:
+                note = "new"
+            line += f"  {note}"
+        print(line, flush=True)
+    loop.close()
+
+    if args.save:
+        os.makedirs(os.path.dirname(os.path.abspath(args.save)), exist_ok=True)
+        with open(args.save, "w") as f:
+            json.dump(
+                {
+                    "created": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                    "python": platform.python_version(),
+                    "machine": platform.machine(),
+                    "results": results,
+                },
+                f,
+                indent=2,
+            )
+        print(f"\nsaved {len(results)} results to {args.save}")
+    if regressions:
+        print(f"\n{regressions} case(s) regressed by over {args.threshold:.0%}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
+    tmp.cleanup()
@@ -0,0 +1,137 @@
+"""Cold start: how long importing the app takes, and how long until it serves.
+
+    python -m bench.startup [--runs N] [--top N] [--no-serve]
+
+Imports app.main in fresh interpreters under ``-X importtime`` and reports the
+median total along with the packages that cost the most. Unless --no-serve is
+given it then starts uvicorn, times how long it takes for /metrics to answer
+and prints the app_startup_seconds breakdown of the startup steps. Set
+TIKTOKEN_CACHE_DIR to a warm cache (as the Docker image does) to leave the
+BPE download out of the numbers.
+"""
+import argparse
+import os
+import re
+import secrets
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from typing import Dict, List, Tuple
+
+import httpx
+
+from bench.jwks import generate_key, serve_jwks
+from bench.loadtest import free_port
+
+IMPORTTIME_LINE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \| ( *)(\S+)")
+
+
+def import_times(env: dict) -> Tuple[float, Dict[str, float]]:
+    """Returns the seconds taken to import app.main and each top-level package."""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import app.main"],
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    total = 0.0
+    packages: Dict[str, float] = defaultdict(float)
+    for line in result.stderr.splitlines():
+        match = IMPORTTIME_LINE.match(line)
+        if match is None:
+            continue
+        cumulative, indent, name = int(match[2]) / 1e6, match[3], match[4]
+        # Only modules imported directly at the top level, so nested imports
+        # aren't counted twice.
+        if len(indent) == 2:
+            total += cumulative
+            packages[name.split(".")[0]] += cumulative
+    return total, packages
+
+
+def time_to_ready(env: dict, timeout: float = 60) -> Tuple[float, str]:
+    port = free_port()
+    start = time.perf_counter()
+    # fmt: off
+    process = subprocess.Popen([
+        sys.executable, "-m", "uvicorn", "app.main:app",
+        "--port", str(port), "--log-level", "warning",
+    ], env=env)
+    # fmt: on
+    try:
+        while True:
+            try:
+                response = httpx.get(
+                    f"http://127.0.0.1:{port}/metrics",
+                    headers={"Authorization": f"Bearer {env['METRICS_TOKEN']}"},
+                )
+                return time.perf_counter() - start, response.text
+            except httpx.TransportError:
+                if time.perf_counter() - start > timeout:
+                    raise RuntimeError("the app did not come up")
+                time.sleep(0.02)
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def startup_steps(metrics: str) -> List[Tuple[str, float]]:
+    return [
+        (match[1], float(match[2]))
+        for match in re.finditer(
+            r'^app_startup_seconds\{phase="([^"]+)"\} (\S+)$', metrics, re.M
+        )
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=10)
+    parser.add_argument("--no-serve", action="store_true")
+    args = parser.parse_args()
+
+    _, jwk = generate_key()
+    jwks = serve_jwks({"keys": [jwk]})
+    tmp = tempfile.TemporaryDirectory()
+    env = {
+        **os.environ,
+        "DATABASE_URL": f"sqlite:///{tmp.name}/startup.db",
+        "CLERK_JWT_ISSUER": f"http://127.0.0.1:{jwks.server_address[1]}",
+        "OPENAI_API_KEY": os.getenv("OPENAI_API_KEY", "unused"),
+        "METRICS_TOKEN": secrets.token_hex(16),
+    }
+    try:
+        # The first run also writes bytecode, so it is left out.
+        import_times(env)
+        runs = [import_times(env) for _ in range(args.runs)]
+        total = statistics.median(total for total, _ in runs)
+        print(f"import app.main: {total * 1000:.0f} ms (median of {args.runs})")
+        packages: Dict[str, List[float]] = defaultdict(list)
+        for _, run in runs:
+            for name, seconds in run.items():
+                packages[name].append(seconds)
+        ranked = sorted(
+            ((statistics.median(s), name) for name, s in packages.items()),
+            reverse=True,
+        )
+        for seconds, name in ranked[: args.top]:
+            print(f"  {name:>20}  {seconds * 1000:>6.1f} ms")
+
+        if args.no_serve:
+            return
+        ready, metrics = time_to_ready(env)
+        print(f"\nuvicorn start to first response: {ready * 1000:.0f} ms")
+        for phase, seconds in startup_steps(metrics):
+            print(f"  {phase:>20}  {seconds * 1000:>6.1f} ms")
+    finally:
+        jwks.shutdown()
+        tmp.cleanup()
+
+
+if __name__ == "__main__":
+    main()
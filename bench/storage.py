@@ -0,0 +1,141 @@
+"""Stored size and load time of a long conversation, per storage format.
+
+    python -m bench.storage [--tokens N] [--runs N]
+
+Builds a synthetic conversation of about N tokens (the fake model's words,
+one token each) and stores it three ways in a scratch sqlite database: as
+the old JSON context blob on the bot, as plain message rows, and as
+compressed message rows (COMPRESS_MESSAGES). For each it reports the bytes
+stored and the time to load the history, with and without decoding every
+message's content.
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import tempfile
+import time
+import uuid
+from typing import Awaitable, Callable, List
+
+tmp = tempfile.TemporaryDirectory()
+os.environ["DATABASE_URL"] = f"sqlite:///{tmp.name}/storage.db"
+
+from sqlalchemy import func, select  # noqa: E402
+
+from app import compression, models  # noqa: E402
+from app.crud import get_messages  # noqa: E402
+from app.database import Base, SessionLocal, engine  # noqa: E402
+from app.fake_llm import fake_reply  # noqa: E402
+
+
+def conversation(tokens: int) -> List[dict]:
+    messages, total, turn = [], 0, 0
+    while total < tokens:
+        role = "user" if turn % 2 == 0 else "assistant"
+        length = 40 if role == "user" else 280
+        prompt = [{"role": "user", "content": f"turn {turn}"}]
+        content = "".join(fake_reply(prompt, length))
+        id = str(uuid.uuid4())
+        messages.append({"role": role, "content": content, "id": id, "tokens": length})
+        total += length
+        turn += 1
+    return messages
+
+
+async def store(messages: List[dict], compress: bool) -> uuid.UUID:
+    compression.COMPRESS_MESSAGES = compress
+    async with SessionLocal() as db:
+        user = models.User(clerk_id=f"bench_{uuid.uuid4().hex}")
+        bot = models.Bot(name="Bench", context={}, tokens=0, creator=user)
+        bot.messages.extend(
+            models.Message(seq=seq, **{**message, "id": str(uuid.uuid4())})
+            for seq, message in enumerate(messages)
+        )
+        db.add(bot)
+        await db.commit()
+        return bot.id
+
+
+async def store_blob(messages: List[dict]) -> uuid.UUID:
+    async with SessionLocal() as db:
+        user = models.User(clerk_id=f"bench_{uuid.uuid4().hex}")
+        bot = models.Bot(
+            name="Bench", context={"messages": messages}, tokens=0, creator=user
+        )
+        db.add(bot)
+        await db.commit()
+        return bot.id
+
+
+async def stored_bytes(bot_id: uuid.UUID) -> int:
+    async with SessionLocal() as db:
+        plain, packed = (
+            await db.execute(
+                select(
+                    func.sum(func.length(models.Message._content)),
+                    func.sum(func.length(models.Message.content_z)),
+                ).where(models.Message.bot_id == bot_id)
+            )
+        ).one()
+    return (plain or 0) + (packed or 0)
+
+
+async def timed(call: Callable[[], Awaitable], runs: int) -> float:
+    samples = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        await call()
+        samples.append(time.perf_counter() - start)
+    return statistics.median(samples) * 1000
+
+
+async def main(tokens: int, runs: int):
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+
+    messages = conversation(tokens)
+    text = sum(len(m["content"]) for m in messages)
+    print(f"{len(messages)} messages, {text / 1024:.0f} KiB of text\n")
+
+    blob_id = await store_blob(messages)
+    plain_id = await store(messages, compress=False)
+    packed_id = await store(messages, compress=True)
+
+    async def load_blob():
+        async with SessionLocal() as db:
+            bot = await db.get(models.Bot, blob_id)
+            return bot.context["messages"]
+
+    def load_rows(bot_id: uuid.UUID, decode: bool):
+        async def load():
+            async with SessionLocal() as db:
+                messages = await get_messages(db, bot_id)
+                return [m.content for m in messages] if decode else messages
+
+        return load
+
+    blob_bytes = len(json.dumps({"messages": messages}).encode())
+    print(f"{'format':>18}  {'stored':>10}  {'load':>9}  {'load+decode':>11}")
+    blob_ms = await timed(load_blob, runs)
+    print(f"{'JSON blob':>18}  {blob_bytes / 1024:>6.0f} KiB  {'':>9}  ", end="")
+    print(f"{blob_ms:>8.1f} ms")
+    for name, bot_id in (("message rows", plain_id), ("compressed rows", packed_id)):
+        size = await stored_bytes(bot_id)
+        load_ms = await timed(load_rows(bot_id, decode=False), runs)
+        decode_ms = await timed(load_rows(bot_id, decode=True), runs)
+        print(f"{name:>18}  {size / 1024:>6.0f} KiB  {load_ms:>6.1f} ms  ", end="")
+        print(f"{decode_ms:>8.1f} ms")
+    print("\nstored counts message content only for the row formats")
+
+    await engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tokens", type=int, default=128_000)
+    parser.add_argument("--runs", type=int, default=10)
+    args = parser.parse_args()
+    asyncio.run(main(args.tokens, args.runs))
+    tmp.cleanup()
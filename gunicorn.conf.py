@@ -0,0 +1,81 @@
+"""Production server: gunicorn managing uvicorn workers.
+
+    gunicorn --config gunicorn.conf.py app.main:app
+
+The app is imported once in the master and forked into WEB_CONCURRENCY
+workers. Send the master SIGHUP to replace the workers one generation at a
+time: each old worker stops accepting connections, lets open /chat streams
+finish for up to STREAM_DRAIN_TIMEOUT seconds and flushes its unwritten turns
+before exiting.
+
+Everything below that is read from the environment is set here, before the
+app is imported, so the master and every worker agree on it.
+"""
+import logging
+import os
+import shutil
+import tempfile
+
+logger = logging.getLogger("gunicorn.error")
+
+# One worker: /chat resume (Last-Event-ID) only finds a reply on the worker
+# that is generating it, and the workers share one socket, so nothing can keep
+# a client on one worker. With several, most reconnects get a 204 and the rest
+# of the reply is lost. Rate limits and per-bot turn ordering are per worker
+# too.
+workers = int(os.environ.setdefault("WEB_CONCURRENCY", "1"))
+bind = f"0.0.0.0:{os.getenv('PORT', '80')}"
+preload_app = True
+worker_class = "app.worker.Worker"
+
+# The same settings app.worker and app.persistence read.
+STREAM_DRAIN_TIMEOUT = int(os.getenv("STREAM_DRAIN_TIMEOUT", "60"))
+PERSIST_SHUTDOWN_TIMEOUT = float(os.getenv("PERSIST_SHUTDOWN_TIMEOUT", "30"))
+# Draining streams, then the persistence worker's two waits (in-flight
+# streams, then the queue), before the master gives up and kills the worker.
+graceful_timeout = STREAM_DRAIN_TIMEOUT + int(2 * PERSIST_SHUTDOWN_TIMEOUT) + 5
+
+# Recycling workers after a number of requests is off unless asked for.
+max_requests = int(os.getenv("MAX_REQUESTS", "0"))
+max_requests_jitter = int(os.getenv("MAX_REQUESTS_JITTER", "0"))
+
+# Metrics are collected across workers through files in this directory.
+os.environ.setdefault(
+    "PROMETHEUS_MULTIPROC_DIR", tempfile.mkdtemp(prefix="prometheus_multiproc_")
+)
+
+if workers > 1:
+    # The lookup cache is per process and only the worker that made a change
+    # invalidates its own copy, so keep other workers' stale entries short.
+    os.environ.setdefault("LOOKUP_CACHE_TTL", "5")
+
+
+def on_starting(server):
+    if workers > 1:
+        logger.warning(
+            "running %d workers: /chat resume, rate limits and per-bot turn "
+            "ordering only hold within a worker",
+            workers,
+        )
+    # Files left by a previous run would be summed into this one's metrics.
+    directory = os.environ["PROMETHEUS_MULTIPROC_DIR"]
+    shutil.rmtree(directory, ignore_errors=True)
+    os.makedirs(directory, exist_ok=True)
+
+
+def when_ready(server):
+    # Load what the workers would each load on startup once, in the master,
+    # so forked workers share it instead of repeating the work.
+    from app.lib import get_encoding
+
+    try:
+        get_encoding()
+        import openai  # noqa: F401
+    except Exception:
+        logger.exception("failed to preload the tokenizer or openai")
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+
+    multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,17 @@
+import os
+import tempfile
+
+# app.database reads these when it is imported, so they are set before any
+# test module imports the app. The "replica" is a second sqlite file that only
+# changes when a test copies the primary over it.
+_databases = tempfile.mkdtemp(prefix="tests_")
+os.environ.update(
+    DATABASE_URL=f"sqlite:///{_databases}/primary.db",
+    DATABASE_REPLICA_URL=f"sqlite:///{_databases}/replica.db",
+    REPLICA_PIN_SECONDS="0.5",
+    ENV="dev",
+    CLERK_JWT_ISSUER="http://127.0.0.1:1",
+    LLM_BACKEND="fake",
+    OPENAI_API_KEY="test",
+    FAKE_LLM_LATENCY_MS="0",
+)
@@ -0,0 +1,152 @@
+import asyncio
+import shutil
+
+import httpx
+import pytest
+from prometheus_client import REGISTRY
+
+import app.lib
+import app.main as main
+from app.cache import lookup_cache
+from app.database import Base, engine, replica_engine
+
+AUTH = {"Authorization": "Bearer test"}
+
+
+class WordEncoding:
+    # Stands in for tiktoken, whose BPE files would be downloaded.
+    def encode_ordinary(self, text):
+        return text.split()
+
+
+def reads(database: str) -> float:
+    value = REGISTRY.get_sample_value(
+        "db_read_sessions_total", {"database": database}
+    )
+    return value or 0.0
+
+
+async def replicate():
+    # Catch the replica up with the primary.
+    await replica_engine.dispose()
+    shutil.copy(engine.url.database, replica_engine.url.database)
+
+
+async def message_count(client: httpx.AsyncClient) -> int:
+    response = await client.get("/bot/messages", headers=AUTH)
+    response.raise_for_status()
+    return len(response.json()["messages"])
+
+
+async def flush():
+    # Wait for the persistence worker to write every finished turn.
+    await main.persistence_worker.stop()
+    main.persistence_worker.start()
+
+
+@pytest.fixture(scope="module")
+def runner():
+    # One event loop for the module: the app's engines and queues are created
+    # once and can't move between loops.
+    with asyncio.Runner() as runner:
+        yield runner
+
+
+@pytest.fixture
+def run(runner, monkeypatch):
+    monkeypatch.setattr(app.lib, "get_encoding", WordEncoding)
+
+    async def with_client(test):
+        for db in (engine, replica_engine):
+            async with db.begin() as conn:
+                await conn.run_sync(Base.metadata.drop_all)
+                await conn.run_sync(Base.metadata.create_all)
+        lookup_cache.clear()
+        main.persistence_worker.start()
+        transport = httpx.ASGITransport(app=main.app)
+        try:
+            async with httpx.AsyncClient(
+                transport=transport, base_url="http://test"
+            ) as client:
+                await test(client)
+        finally:
+            await main.persistence_worker.stop()
+
+    return lambda test: runner.run(with_client(test))
+
+
+def test_reads_follow_own_chat_turn(run):
+    async def test(client):
+        # The replica doesn't have the new bot yet, so this falls back to the
+        # primary to create it.
+        assert (await client.get("/bot", headers=AUTH)).status_code == 200
+        await replicate()
+        assert await message_count(client) == 1
+
+        response = await client.get("/chat", params={"message": "hi"}, headers=AUTH)
+        assert response.status_code == 200
+        assert "read_pin" in response.cookies
+        await flush()
+
+        # Past REPLICA_PIN_SECONDS, so it is the message count in the pin that
+        # keeps the read off the replica. The cache already counts the turn's
+        # messages; the replica doesn't have them.
+        await asyncio.sleep(0.6)
+        primary = reads("primary")
+        assert await message_count(client) == 3
+        assert reads("primary") == primary + 1
+
+        await replicate()
+        primary, replica = reads("primary"), reads("replica")
+        assert await message_count(client) == 3
+        assert reads("replica") == replica + 1
+        assert reads("primary") == primary
+
+    run(test)
+
+
+def test_reads_return_to_replica_when_pin_expires(run):
+    async def test(client):
+        assert (await client.get("/bot", headers=AUTH)).status_code == 200
+        await replicate()
+
+        assert (await client.delete("/bot", headers=AUTH)).status_code == 200
+        primary, replica = reads("primary"), reads("replica")
+        response = await client.get("/bot/messages", headers=AUTH)
+        assert response.status_code == 404
+        assert reads("primary") == primary + 1
+        assert reads("replica") == replica
+
+        await asyncio.sleep(0.6)
+        # As if the read reached a worker that didn't serve the delete.
+        lookup_cache.clear()
+        # The replica still has the deleted bot. Reading it is allowed again
+        # once the user's pin has run out.
+        response = await client.get("/bot/messages", headers=AUTH)
+        assert response.status_code == 200
+        assert reads("replica") == replica + 1
+
+    run(test)
+
+
+def test_page_etag_matches_the_rows_served(run):
+    async def test(client):
+        assert (await client.get("/bot", headers=AUTH)).status_code == 200
+        await replicate()
+        response = await client.get("/chat", params={"message": "hi"}, headers=AUTH)
+        assert response.status_code == 200
+        await flush()
+
+        # Without a pin the replica's page is served, while the cache already
+        # counts the turn's messages.
+        client.cookies.clear()
+        response = await client.get("/bot/messages", headers=AUTH)
+        assert len(response.json()["messages"]) == 1
+        stale = {"If-None-Match": response.headers["ETag"], **AUTH}
+
+        await replicate()
+        response = await client.get("/bot/messages", headers=stale)
+        assert response.status_code == 200
+        assert len(response.json()["messages"]) == 3
+
+    run(test)